@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+#
+# bench_dq.py
+#
+# Times the stages of the DQ driver path (file discovery, macro writing,
+# output clean up and DQ status aggregation) on synthetic run archives,
+# using the stub rat executable and rat module in benchmarks/stub
+#
+###############################################################################
+import contextlib
+import json
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+_bench_dir = os.path.dirname(os.path.abspath(__file__))
+_repo_dir = os.path.dirname(_bench_dir)
+_stub_dir = os.path.join(_bench_dir, "stub")
+sys.path[:0] = [_stub_dir, _repo_dir, os.path.join(_repo_dir, "utils")]
+
+import bit_manips
+import check_dq_status
+import dq_cache
+import dq_discovery
+import run_dq
+
+TEMPLATE = """/rat/physics_list/OmitAll true
+/run/initialize
+/rat/proc dqrunproc
+/rat/proc dqpmtproc
+/rat/proc dqtimeproc
+/rat/proc dqtriggerproc
+/rat/proclast outroot
+/rat/inzdab/read_default
+exit
+"""
+
+@contextlib.contextmanager
+def quiet():
+    """ Sends stdout to /dev/null, hiding the progress printed by the code
+    being timed
+    """
+    stdout = sys.stdout
+    with open(os.devnull, "w") as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+def build_archive(top, n_files, subruns_per_run=20, seed=1):
+    """ Writes n_files raw zdabs SNOP_<run>_<subrun>.zdab, one directory per
+    run, each with a stub _p1.root file holding random DQ flag and applied
+    words. Directory mtimes are set an hour back, so that the directory
+    index treats them as settled. Returns the lists of zdab and root paths.
+    """
+    generator = random.Random(seed)
+    all_bits = (1<<len(check_dq_status.DQ_BIT_NAMES))-1
+    zdabs = []
+    roots = []
+    for index in range(n_files):
+        run = 100000+index//subruns_per_run
+        subrun = index%subruns_per_run
+        run_dir = os.path.join(top, str(run))
+        if (subrun == 0):
+            os.mkdir(run_dir)
+        name = "SNOP_%010d_%03d" % (run, subrun)
+        zdab = os.path.join(run_dir, name+".zdab")
+        open(zdab, "w").close()
+        root = os.path.join(run_dir, name+"_p1.root")
+        applied = all_bits & ~generator.getrandbits(2)
+        flags = applied & ~(1<<generator.randrange(16))
+        with open(root, "w") as root_file:
+            root_file.write(str(flags)+" "+str(applied)+"\n")
+        zdabs.append(zdab)
+        roots.append(root)
+    past = time.time()-3600
+    for directory, dirs, files in os.walk(top):
+        os.utime(directory, (past, past))
+    return zdabs, roots
+
+def set_environment(work):
+    """ Points RAT and the DQ output directories at a scratch area, and puts
+    the stub rat executable on the PATH
+    """
+    macro_dir = os.path.join(work, "rat", "mac", "processing")
+    os.makedirs(macro_dir)
+    with open(os.path.join(macro_dir, "processing.mac"), "w") as template:
+        template.write(TEMPLATE)
+    os.environ["RATROOT"] = os.path.join(work, "rat")
+    for name in ["RECORDS", "PLOTS", "LOGS"]:
+        os.environ[name] = os.path.join(work, name.lower())
+        os.mkdir(os.environ[name])
+    os.environ["PATH"] = os.path.join(_stub_dir, "bin")+os.pathsep \
+        +os.environ.get("PATH", "")
+
+def timed(stage, n_files, n_items, function, *args):
+    """ Calls function(*args) and returns a result record for stage """
+    start = time.time()
+    with quiet():
+        function(*args)
+    seconds = time.time()-start
+    return {"stage": stage, "n_files": n_files, "n_items": n_items,
+            "seconds": seconds,
+            "us_per_item": 1e6*seconds/n_items if n_items else None}
+
+def bench_write_macro(paths, macro_dir):
+    for path in paths:
+        run_dq.RunDQ(path, 1).write_macro(macro_dir, echo=False)
+
+def bench_clean_up(paths, scratch):
+    hostname = socket.gethostname()
+    for index, path in enumerate(paths):
+        data_quality = run_dq.RunDQ(path, 1)
+        work_dir = os.path.join(scratch, str(index))
+        os.mkdir(work_dir)
+        run = dq_discovery.parse_name(path).run
+        for name in ["DATAQUALITY_RECORDS_"+str(run)+".ratdb",
+                     "dq_checks_"+str(run)+".png",
+                     "rat."+hostname+"."+str(index)+".log"]:
+            open(os.path.join(work_dir, name), "w").close()
+        data_quality.clean_up(False, 2, work_dir)
+
+def bench_status(roots, bit_indices):
+    cache = dq_cache.DQStatusCache(check_dq_status.DQ_BIT_NAMES, bit_indices)
+    cache.update(roots, lambda path:
+                     check_dq_status.read_dq_words(path, bit_indices))
+    return cache
+
+def bench_aggregate(cache, bit_indices):
+    bit_manips.count_masks(cache.flags, cache.applied, bit_indices)
+
+def bench_rat(paths, temp_dir):
+    for path in paths:
+        run_dq.process_file(path, 1, False, 2, temp_dir)
+
+def run_benchmarks(n_files, max_items, n_rat, label):
+    """ Runs every stage on an archive of n_files files. The per-file stages
+    are run on at most max_items files. Returns a list of result records.
+    """
+    work = tempfile.mkdtemp(prefix="bench_dq_")
+    results = []
+    try:
+        set_environment(work)
+        archive = os.path.join(work, "archive")
+        os.mkdir(archive)
+        zdabs, roots = build_archive(archive, n_files)
+        n_items = min(n_files, max_items)
+        index_path = os.path.join(work, "index.json")
+        results.append(timed("discovery", n_files, n_files,
+                             dq_discovery.find_files, archive, "zdab", None))
+        results.append(timed("discovery_index_cold", n_files, n_files,
+                             dq_discovery.find_files, archive, "zdab", None,
+                             index_path))
+        results.append(timed("discovery_index_warm", n_files, n_files,
+                             dq_discovery.find_files, archive, "zdab", None,
+                             index_path))
+        macro_dir = os.path.join(work, "macros")
+        os.mkdir(macro_dir)
+        results.append(timed("write_macro", n_files, n_items,
+                             bench_write_macro, zdabs[:n_items], macro_dir))
+        scratch = os.path.join(work, "scratch")
+        os.mkdir(scratch)
+        results.append(timed("clean_up", n_files, n_items,
+                             bench_clean_up, zdabs[:n_items], scratch))
+        bit_indices = check_dq_status.get_bit_indices()
+        start = time.time()
+        with quiet():
+            cache = bench_status(roots, bit_indices)
+        seconds = time.time()-start
+        results.append({"stage": "status_read", "n_files": n_files,
+                        "n_items": n_files, "seconds": seconds,
+                        "us_per_item": 1e6*seconds/n_files})
+        results.append(timed("status_aggregate", n_files, n_files,
+                             bench_aggregate, cache, bit_indices))
+        if (n_rat > 0):
+            rat_dir = os.path.join(work, "rat_work")
+            os.mkdir(rat_dir)
+            results.append(timed("run_rat", n_files, min(n_rat, n_files),
+                                 bench_rat, zdabs[:n_rat], rat_dir))
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    for result in results:
+        result["label"] = label
+        result["time"] = time.time()
+    return results
+
+###############################################################################
+if __name__=="__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the DQ driver "
+                                     "path on synthetic archives")
+    parser.add_argument("-n", "--sizes", type=int, nargs="+",
+                        default=[100, 1000, 10000],
+                        help="archive sizes (number of subrun files)")
+    parser.add_argument("-m", "--max-items", type=int, default=2000,
+                        help="largest number of files for the per-file "
+                        "write_macro and clean_up stages")
+    parser.add_argument("-r", "--rat", type=int, default=0,
+                        help="also time full processing of this many files "
+                        "with the stub rat executable")
+    parser.add_argument("-l", "--label", default="",
+                        help="label stored with each result, e.g. a commit")
+    parser.add_argument("-o", "--output", help="append JSON-lines results "
+                        "to this file, rather than printing them")
+    args = parser.parse_args()
+
+    for n_files in args.sizes:
+        results = run_benchmarks(n_files, args.max_items, args.rat, args.label)
+        lines = [json.dumps(result, sort_keys=True) for result in results]
+        if args.output:
+            with open(args.output, "a") as output:
+                output.write("\n".join(lines)+"\n")
+        else:
+            print "\n".join(lines)
+        for result in results:
+            sys.stderr.write("%-22s n=%-7d %10.3f s %12.1f us/item\n" %
+                             (result["stage"], n_files, result["seconds"],
+                              result["us_per_item"] or 0.))
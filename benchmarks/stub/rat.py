@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+#
+# rat.py
+#
+# Stub of the RAT python module for benchmarks. dsreader reads the DQ flag
+# and applied words written by the stub rat executable (or by the benchmark
+# archive builder) from the first line of the "Root" file.
+#
+###############################################################################
+# Bit order used by the stub, matching check_dq_status.DQ_BIT_NAMES
+_bit_names = ["run_type", "mc_flag", "trigger", "run_length",
+              "general_coverage", "crate_coverage", "panel_coverage",
+              "run_header", "delta_t_comparison", "clock_forward",
+              "event_separation", "retriggers", "event_rate"]
+
+class _BitMask(object):
+    """ Stands in for a RAT BitMask """
+    def __init__(self, word):
+        self._word = word
+    def Get(self, index):
+        return bool(self._word & (1<<index))
+
+class _DataQualityFlags(object):
+    """ Stands in for RAT::DS::DataQualityFlags """
+    def __init__(self, flags, applied):
+        self._flags = _BitMask(flags)
+        self._applied = _BitMask(applied)
+    def GetFlags(self, index):
+        return self._flags
+    def GetApplied(self, index):
+        return self._applied
+
+class _Run(object):
+    """ Stands in for RAT::DS::Run """
+    def __init__(self, flags, applied):
+        self._dq_flags = _DataQualityFlags(flags, applied)
+    def GetDataQualityFlags(self):
+        return self._dq_flags
+
+def dsreader(path):
+    """ Yields a single (ds, run) pair, as rat.dsreader does """
+    with open(path, "r") as root_file:
+        flags, applied = [int(word) for word in root_file.readline().split()]
+    yield None, _Run(flags, applied)
+
+class _DataQualityBits(object):
+    """ Stands in for RAT::DU::DataQualityBits """
+    def GetBitIndex(self, name):
+        return _bit_names.index(name)
+
+class utility(object):
+    """ Stands in for rat.utility """
+    def GetDataQualityBits(self):
+        return _DataQualityBits()
@@ -8,7 +8,89 @@
 # Author A R Back - 26/02/2014 <ab571@sussex.ac.uk> : First revision
 #
 ###############################################################################
-import rat
+import multiprocessing
+import numpy
+
+import bit_manips
+
+# DQ checks, in the order they appear on the histogram axes
+DQ_BIT_NAMES = ["run_type", "mc_flag", "trigger", "run_length",
+                "general_coverage", "crate_coverage", "panel_coverage",
+                "run_header", "delta_t_comparison", "clock_forward",
+                "event_separation", "retriggers", "event_rate"]
+
+def get_bit_indices(bit_names=DQ_BIT_NAMES):
+    """ Returns the RAT DQ bit index of each of the named checks. Resolve
+    these once and pass them to read_dq_words, rather than looking up bit
+    indices for every file.
+    """
+    import rat # deferred: loading RAT and ROOT takes several seconds
+    dq_bits = rat.utility().GetDataQualityBits()
+    return [dq_bits.GetBitIndex(name) for name in bit_names]
+
+def read_dq_words(path, bit_indices):
+    """ Reads the run-level DQ flags and applied masks from the first run of
+    a DQ-processed root file. Returns them as integer words, where bit i is
+    set if RAT DQ bit i is set, for each of the given bit indices.
+    """
+    import rat
+    events = rat.dsreader(path)
+    ds, run = events.next()
+    dq_flags = run.GetDataQualityFlags()
+    flags = dq_flags.GetFlags(0)
+    applied = dq_flags.GetApplied(0)
+    flags_word = 0
+    applied_word = 0
+    for index in bit_indices:
+        if flags.Get(index):
+            flags_word |= 1<<index
+        if applied.Get(index):
+            applied_word |= 1<<index
+    return flags_word, applied_word
+
+def count_dq_checks(paths, bit_indices):
+    """ Reads the DQ words of each of paths and counts, for each of the given
+    bit indices, the files in which the check passed, failed, was applied
+    and was not applied. Returns the flag and applied words read, as lists,
+    and the counts, as an integer array of shape (4, bits), rows in that
+    order.
+    """
+    words = [read_dq_words(path, bit_indices) for path in paths]
+    flags = [word[0] for word in words]
+    applied = [word[1] for word in words]
+    return flags, applied, count_dq_words(flags, applied, bit_indices)
+
+def count_dq_words(flags, applied, bit_indices):
+    """ As count_dq_checks, but counts given flag and applied words """
+    passed, failed, not_applied = bit_manips.count_masks(flags, applied,
+                                                         bit_indices)
+    return numpy.array([passed, failed, passed+failed, not_applied],
+                       dtype=numpy.int64).reshape(4, len(bit_indices))
+
+def _count_dq_checks_args(args):
+    """ Unpacks an argument tuple for count_dq_checks, for use with
+    Pool.map
+    """
+    return count_dq_checks(*args)
+
+def map_dq_checks(paths, bit_indices, jobs=1):
+    """ Runs count_dq_checks over chunks of paths, with a pool of jobs
+    processes if jobs > 1. Returns a list of (chunk, flags, applied, counts)
+    tuples, one per chunk, whose counts are summed to give the totals.
+    """
+    n_chunks = min(len(paths), jobs*4)
+    chunks = [paths[chunk::n_chunks] for chunk in range(n_chunks)]
+    tasks = [(chunk, bit_indices) for chunk in chunks]
+    if (jobs > 1) and (len(tasks) > 1):
+        pool = multiprocessing.Pool(min(jobs, len(tasks)))
+        try:
+            partials = pool.map(_count_dq_checks_args, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        partials = [count_dq_checks(*task) for task in tasks]
+    return [(chunk,)+partial for chunk, partial in zip(chunks, partials)]
 
 class CheckDQStatus(object):
     """ Base class for analysing the DQ status word """
@@ -21,6 +103,7 @@ class CheckDQStatus(object):
     def get_dq_masks(self):
         """ Reads the RAT DS in DQ-processed root file. Returns DQ status word
         """
+        import rat
         events = rat.dsreader(self._path)
         ds, run = events.next()
         self._dq_flags = run.GetDataQualityFlags().GetFlags(0)
@@ -31,13 +114,11 @@ class CheckDQStatus(object):
 
 ###############################################################################
 if __name__=="__main__":
-    from ROOT import TH1D
-    from ROOT import TFile
-
     import argparse    
     import os
-    import re
-    import math
+
+    import dq_cache
+    import dq_discovery
 
     parser = argparse.ArgumentParser(description="DQ status word analyser"
                                      "specify either directory of files or a"
@@ -48,118 +129,82 @@ if __name__=="__main__":
                         help="supply a pass number to use processed Root files")
     parser.add_argument("-w", "--write", help="Write histograms to file",
                         action="store_true")
+    parser.add_argument("--index", help="file in which to cache directory "
+                        "listings between invocations")
+    parser.add_argument("-c", "--cache", help="columnar (.npz) cache of DQ "
+                        "words; files already in the cache are not re-read")
+    parser.add_argument("-j", "--jobs", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="number of processes reading files (default: "
+                        "one per core)")
+    parser.add_argument("-i", "--interactive", action="store_true",
+                        help="draw the histograms and wait for RETURN")
     args = parser.parse_args()
 
-    file_list = []
-    for root, dirs, files in os.walk(args.directory):
-        for file in files:
-            match = False
-            if args.passnum:
-                if (file.find(r"SNOP_[0-9]+_[0-9]+_p"+str(args.passnum)+".root") > 0):
-                    match = True
-            else:
-                match = re.search(r"SNOP_[0-9]+_[0-9]+_p[0-9]+.root", file)
-            if match:
-                file_list.append(os.path.join(root, file))
-    max_bits = 13
-    utility = rat.utility()
-    dq_bits = utility.GetDataQualityBits()
-
-    hist_title = "Performance of DQ checks"
-    hist_dq_flags = TH1D("TH1D_dq_status", hist_title, max_bits, 0, max_bits) 
-    hist_dq_flags.GetXaxis().SetBinLabel(1, "run_type")
-    hist_dq_flags.GetXaxis().SetBinLabel(2, "mc_flag")
-    hist_dq_flags.GetXaxis().SetBinLabel(3, "trigger")
-    hist_dq_flags.GetXaxis().SetBinLabel(4, "run_length")
-    hist_dq_flags.GetXaxis().SetBinLabel(5, "general_coverage")
-    hist_dq_flags.GetXaxis().SetBinLabel(6, "crate_coverage")
-    hist_dq_flags.GetXaxis().SetBinLabel(7, "panel_coverage")
-    hist_dq_flags.GetXaxis().SetBinLabel(8, "run_header")
-    hist_dq_flags.GetXaxis().SetBinLabel(9, "delta_t_comparison")
-    hist_dq_flags.GetXaxis().SetBinLabel(10, "clock_forward")
-    hist_dq_flags.GetXaxis().SetBinLabel(11, "event_separation")
-    hist_dq_flags.GetXaxis().SetBinLabel(12, "retriggers")
-    hist_dq_flags.GetXaxis().SetBinLabel(13, "event_rate")
-    hist_dq_applied = TH1D("TH1D_dq_applied", hist_title, max_bits, 0, max_bits) 
-    hist_dq_applied.GetXaxis().SetBinLabel(1, "run_type")
-    hist_dq_applied.GetXaxis().SetBinLabel(2, "mc_flag")
-    hist_dq_applied.GetXaxis().SetBinLabel(3, "trigger")
-    hist_dq_applied.GetXaxis().SetBinLabel(4, "run_length")
-    hist_dq_applied.GetXaxis().SetBinLabel(5, "general_coverage")
-    hist_dq_applied.GetXaxis().SetBinLabel(6, "crate_coverage")
-    hist_dq_applied.GetXaxis().SetBinLabel(7, "panel_coverage")
-    hist_dq_applied.GetXaxis().SetBinLabel(8, "run_header")
-    hist_dq_applied.GetXaxis().SetBinLabel(9, "delta_t_comparison")
-    hist_dq_applied.GetXaxis().SetBinLabel(10, "clock_forward")
-    hist_dq_applied.GetXaxis().SetBinLabel(11, "event_separation")
-    hist_dq_applied.GetXaxis().SetBinLabel(12, "retriggers")
-    hist_dq_applied.GetXaxis().SetBinLabel(13, "event_rate")
-    for file in file_list:
-        events = rat.dsreader(file)
-        ds, run = events.next()
-        flags = run.GetDataQualityFlags().GetFlags(0)
-        applied = run.GetDataQualityFlags().GetApplied(0)
-        if(flags.Get(dq_bits.GetBitIndex("run_type"))):
-            hist_dq_flags.AddBinContent(1)
-        if(applied.Get(dq_bits.GetBitIndex("run_type"))):
-            hist_dq_applied.AddBinContent(1)
-        if(flags.Get(dq_bits.GetBitIndex("mc_flag"))):
-            hist_dq_flags.AddBinContent(2)
-        if(applied.Get(dq_bits.GetBitIndex("mc_flag"))):
-            hist_dq_applied.AddBinContent(2)
-        if(flags.Get(dq_bits.GetBitIndex("trigger"))):
-            hist_dq_flags.AddBinContent(3)
-        if(applied.Get(dq_bits.GetBitIndex("trigger"))):
-            hist_dq_applied.AddBinContent(3)
-        if(flags.Get(dq_bits.GetBitIndex("run_length"))):
-            hist_dq_flags.AddBinContent(4)
-        if(applied.Get(dq_bits.GetBitIndex("run_length"))):
-            hist_dq_applied.AddBinContent(4)
-        if(flags.Get(dq_bits.GetBitIndex("general_coverage"))):
-            hist_dq_flags.AddBinContent(5)
-        if(applied.Get(dq_bits.GetBitIndex("general_coverage"))):
-            hist_dq_applied.AddBinContent(5)
-        if(flags.Get(dq_bits.GetBitIndex("crate_coverage"))):
-            hist_dq_flags.AddBinContent(6)
-        if(applied.Get(dq_bits.GetBitIndex("crate_coverage"))):
-            hist_dq_applied.AddBinContent(6)
-        if(flags.Get(dq_bits.GetBitIndex("panel_coverage"))):
-            hist_dq_flags.AddBinContent(7)
-        if(applied.Get(dq_bits.GetBitIndex("panel_coverage"))):
-            hist_dq_applied.AddBinContent(7)
-        if(flags.Get(dq_bits.GetBitIndex("run_header"))):
-            hist_dq_flags.AddBinContent(8)
-        if(applied.Get(dq_bits.GetBitIndex("run_header"))):
-            hist_dq_applied.AddBinContent(8)
-        if(flags.Get(dq_bits.GetBitIndex("delta_t_comparison"))):
-            hist_dq_flags.AddBinContent(9)
-        if(applied.Get(dq_bits.GetBitIndex("delta_t_comparison"))):
-            hist_dq_applied.AddBinContent(9)
-        if(flags.Get(dq_bits.GetBitIndex("clock_forward"))):
-            hist_dq_flags.AddBinContent(10)
-        if(applied.Get(dq_bits.GetBitIndex("clock_forward"))):
-            hist_dq_applied.AddBinContent(10)
-        if(flags.Get(dq_bits.GetBitIndex("event_separation"))):
-            hist_dq_flags.AddBinContent(11)
-        if(applied.Get(dq_bits.GetBitIndex("event_separation"))):
-            hist_dq_applied.AddBinContent(11)
-        if(flags.Get(dq_bits.GetBitIndex("retriggers"))):
-            hist_dq_flags.AddBinContent(12)
-        if(applied.Get(dq_bits.GetBitIndex("retriggers"))):
-            hist_dq_applied.AddBinContent(12)
-        if(flags.Get(dq_bits.GetBitIndex("event_rate"))):
-            hist_dq_flags.AddBinContent(13)
-        if(applied.Get(dq_bits.GetBitIndex("event_rate"))):
-            hist_dq_applied.AddBinContent(13)
-    hist_dq_flags.Draw()
+    if args.passnum:
+        records = dq_discovery.find_files(args.directory, "root",
+                                          args.passnum, args.index)
+    else:
+        records = [record for record in
+                   dq_discovery.find_files(args.directory, "root",
+                                           index_path=args.index)
+                   if record.pass_number is not None]
+    file_list = [record.path for record in records]
+
+    if args.cache and os.path.exists(args.cache):
+        cache = dq_cache.DQStatusCache.load(args.cache)
+        bit_indices = cache.bit_indices
+    else:
+        bit_indices = get_bit_indices()
+        cache = dq_cache.DQStatusCache(DQ_BIT_NAMES, bit_indices)
+
+    # map: count DQ check outcomes in chunks of the files that are not
+    # cached, in parallel; cached files are counted from the cache
+    stale = cache.stale_files(file_list)
+    partials = map_dq_checks(stale, bit_indices, args.jobs)
+    in_list = numpy.in1d(cache.path, file_list) & ~numpy.in1d(cache.path,
+                                                              stale)
+    counts = count_dq_words(cache.flags[in_list], cache.applied[in_list],
+                            bit_indices)
+    # reduce: merge the partial counts, and cache the words read
+    for chunk, flags, applied, partial in partials:
+        counts += partial
+        cache.add(chunk, flags, applied)
+    print "check_dq_status.py: read", len(stale), "files,", len(cache),
+    print "cached"
+    if args.cache:
+        cache.save(args.cache)
+
+    for bin, bit_name in enumerate(DQ_BIT_NAMES):
+        print "%-20s passed %6d failed %6d not applied %6d" % \
+            (bit_name, counts[0][bin], counts[1][bin], counts[3][bin])
+
+    # ROOT is only needed, and loaded, to write or draw the histograms
+    if args.write or args.interactive:
+        from ROOT import TH1D
+        from ROOT import TFile
+
+        max_bits = len(DQ_BIT_NAMES)
+        hists = []
+        for name, title in [("TH1D_dq_status", "DQ checks passed"),
+                            ("TH1D_dq_failed", "DQ checks failed"),
+                            ("TH1D_dq_applied", "DQ checks applied"),
+                            ("TH1D_dq_not_applied", "DQ checks not applied")]:
+            hist = TH1D(name, title, max_bits, 0, max_bits)
+            for bin, bit_name in enumerate(DQ_BIT_NAMES):
+                hist.GetXaxis().SetBinLabel(bin+1, bit_name)
+                hist.SetBinContent(bin+1, counts[len(hists)][bin])
+            hists.append(hist)
     if args.write:
         if args.passnum:
             filename = "check_dq_status_records_p"+str(args.passnum)+".root"
         else:
             filename = "check_dq_status_records.root"
         output_file = TFile(filename, "RECREATE")
-        hist_dq_checks.Write("TH1D_dq_status")
-        output_file.Write()
+        for hist in hists:
+            hist.Write()
         output_file.ls()
         output_file.Close()
-    raw_input("RETURN to exit")
+    if args.interactive:
+        hists[0].Draw()
+        raw_input("RETURN to exit")
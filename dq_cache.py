@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+#
+# dq_cache.py
+#
+# Columnar cache of the run-level DQ flag and applied words read from
+# DQ-processed root files, stored as a NumPy .npz file
+#
+###############################################################################
+import numpy
+import os
+
+import dq_discovery
+
+class DQStatusCache(object):
+    """ Holds one row per DQ-processed file: path, mtime, run, subrun, pass
+    number and the 64-bit DQ flag and applied words. Bit i of each word is
+    the RAT DQ bit with index i.
+    """
+    _columns = ["path", "mtime", "run", "subrun", "pass_number",
+                "flags", "applied"]
+    _dtypes = {"path": object, "mtime": numpy.float64, "run": numpy.int64,
+               "subrun": numpy.int64, "pass_number": numpy.int64,
+               "flags": numpy.uint64, "applied": numpy.uint64}
+    def __init__(self, bit_names=(), bit_indices=()):
+        """ Creates an empty cache for the given DQ bit names and the
+        corresponding RAT bit indices
+        """
+        self.bit_names = list(bit_names)
+        self.bit_indices = [int(index) for index in bit_indices]
+        for column in self._columns:
+            setattr(self, column,
+                    numpy.zeros(0, dtype=self._dtypes[column]))
+    def __len__(self):
+        return len(self.path)
+    @classmethod
+    def load(cls, path):
+        """ Loads a cache previously written with save """
+        data = numpy.load(path)
+        cache = cls(data["bit_names"], data["bit_indices"])
+        for column in cls._columns:
+            setattr(cache, column, data[column].astype(cls._dtypes[column]))
+        return cache
+    def save(self, path):
+        """ Writes the cache to path. The file is written to a temporary name
+        and then renamed, so readers never see a partial cache.
+        """
+        temp_path = path + ".tmp." + str(os.getpid())
+        arrays = dict((column, getattr(self, column))
+                      for column in self._columns)
+        arrays["path"] = numpy.array(list(self.path), dtype=str)
+        with open(temp_path, "wb") as cache_file:
+            numpy.savez_compressed(cache_file,
+                                   bit_names=numpy.array(self.bit_names),
+                                   bit_indices=numpy.array(self.bit_indices),
+                                   **arrays)
+        os.rename(temp_path, path)
+    def stale_files(self, file_list):
+        """ Returns the files in file_list that are not yet cached, or whose
+        mtime has changed since they were cached
+        """
+        cached = dict((path, mtime)
+                      for path, mtime in zip(self.path, self.mtime))
+        return [path for path in file_list
+                if cached.get(path) != os.stat(path).st_mtime]
+    def add(self, paths, flags, applied):
+        """ Adds rows for paths with the given flag and applied words,
+        replacing any rows already cached for them. Returns the number of
+        rows added.
+        """
+        rows = []
+        for path, flags_word, applied_word in zip(paths, flags, applied):
+            record = dq_discovery.parse_name(path)
+            if (record is None) or (record.pass_number is None):
+                print "DQStatusCache.add: warning, skipping", path
+                continue
+            rows.append((path, os.stat(path).st_mtime, record.run,
+                         record.subrun, record.pass_number, flags_word,
+                         applied_word))
+        if not rows:
+            return 0
+        keep = ~numpy.in1d(self.path, [row[0] for row in rows])
+        for column, values in zip(self._columns, zip(*rows)):
+            new = numpy.array(values, dtype=self._dtypes[column])
+            setattr(self, column,
+                    numpy.concatenate([getattr(self, column)[keep], new]))
+        return len(rows)
+    def update(self, file_list, reader):
+        """ Adds rows for the stale_files in file_list. reader is called as
+        reader(path) for each of these files and must return the flag and
+        applied words as integers. Returns the number of files read.
+        """
+        paths = []
+        for path in self.stale_files(file_list):
+            record = dq_discovery.parse_name(path)
+            if (record is None) or (record.pass_number is None):
+                print "DQStatusCache.update: warning, skipping", path
+            else:
+                paths.append(path)
+        words = [reader(path) for path in paths]
+        return self.add(paths, [word[0] for word in words],
+                        [word[1] for word in words])
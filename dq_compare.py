@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+#
+# dq_compare.py
+#
+# Compares the DQ check outcomes of two processing passes, subrun by subrun,
+# using the columnar cache of DQ words so that only new or modified pass
+# outputs are read
+#
+###############################################################################
+import numpy
+
+import bit_manips
+
+# Outcome codes of a DQ check
+NOT_APPLIED, PASSED, FAILED = 0, 1, 2
+OUTCOME_NAMES = {NOT_APPLIED: "not applied", PASSED: "passed",
+                 FAILED: "failed"}
+
+def get_outcomes(flags, applied, bit_indices):
+    """ Returns a matrix of outcome codes, of shape (entries, bits), for
+    arrays of flag and applied words and the given bit indices, see
+    bit_manips.query_masks
+    """
+    passed, failed, not_applied = bit_manips.query_masks(flags, applied,
+                                                         bit_indices)
+    outcomes = numpy.zeros(passed.shape, dtype=numpy.int8) # NOT_APPLIED
+    outcomes[passed] = PASSED
+    outcomes[failed] = FAILED
+    return outcomes
+
+def index_pass(cache, pass_number, paths=None):
+    """ Returns a dict from (run, subrun) to the row of cache holding that
+    subrun for pass_number, only considering rows for paths if it is given.
+    If a subrun was cached more than once for the pass, e.g. from two
+    directories, the most recently modified file is used.
+    """
+    index = {}
+    selected = (cache.pass_number == pass_number)
+    if paths is not None:
+        selected &= numpy.in1d(cache.path, paths)
+    rows = numpy.nonzero(selected)[0]
+    for row in rows[numpy.argsort(cache.mtime[rows], kind="mergesort")]:
+        index[(int(cache.run[row]), int(cache.subrun[row]))] = row
+    return index
+
+def compare_passes(cache, pass_a, pass_b, paths=None):
+    """ Joins the cached DQ words of pass_a and pass_b on run and subrun,
+    using only the rows for paths if it is given, see index_pass.
+    Returns a tuple of: the number of subruns found in both passes; a list
+    of (run, subrun, [(bit name, outcome in pass_a, outcome in pass_b),
+    ...]) for subruns in which any outcome changed, sorted by run and
+    subrun; the sorted (run, subrun) keys only found in pass_a; and those
+    only found in pass_b.
+    """
+    index_a = index_pass(cache, pass_a, paths)
+    index_b = index_pass(cache, pass_b, paths)
+    keys = sorted(set(index_a) & set(index_b))
+    only_a = sorted(set(index_a) - set(index_b))
+    only_b = sorted(set(index_b) - set(index_a))
+    rows_a = numpy.array([index_a[key] for key in keys], dtype=numpy.int64)
+    rows_b = numpy.array([index_b[key] for key in keys], dtype=numpy.int64)
+    outcomes_a = get_outcomes(cache.flags[rows_a], cache.applied[rows_a],
+                              cache.bit_indices)
+    outcomes_b = get_outcomes(cache.flags[rows_b], cache.applied[rows_b],
+                              cache.bit_indices)
+    changes = []
+    for entry in numpy.nonzero((outcomes_a != outcomes_b).any(axis=1))[0]:
+        bits = numpy.nonzero(outcomes_a[entry] != outcomes_b[entry])[0]
+        changes.append(keys[entry] +
+                       ([(cache.bit_names[bit],
+                          OUTCOME_NAMES[outcomes_a[entry, bit]],
+                          OUTCOME_NAMES[outcomes_b[entry, bit]])
+                         for bit in bits],))
+    return len(keys), changes, only_a, only_b
+
+def count_changes(changes):
+    """ Returns a dict from (bit name, outcome before, outcome after) to the
+    number of subruns with that change
+    """
+    counts = {}
+    for run, subrun, bits in changes:
+        for change in bits:
+            counts[change] = counts.get(change, 0)+1
+    return counts
+
+###############################################################################
+if __name__=="__main__":
+    import argparse
+    import multiprocessing
+    import os
+
+    import check_dq_status
+    import dq_cache
+    import dq_discovery
+
+    parser = argparse.ArgumentParser(description="Compare the DQ check "
+                                     "outcomes of two passes, by subrun")
+    parser.add_argument("directory", help="directory containing DQ-processed "
+                        "root files of both passes")
+    parser.add_argument("pass_a", type=int, help="earlier pass number")
+    parser.add_argument("pass_b", type=int, help="later pass number")
+    parser.add_argument("-c", "--cache", help="columnar (.npz) cache of DQ "
+                        "words; files already in the cache are not re-read")
+    parser.add_argument("--index", help="file in which to cache directory "
+                        "listings between invocations")
+    parser.add_argument("-j", "--jobs", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="number of processes reading files (default: "
+                        "one per core)")
+    parser.add_argument("-s", "--summary", action="store_true",
+                        help="only print the number of changes per bit")
+    args = parser.parse_args()
+
+    file_list = [record.path for record in
+                 dq_discovery.find_files(args.directory, "root",
+                                         index_path=args.index)
+                 if record.pass_number in (args.pass_a, args.pass_b)]
+    if args.cache and os.path.exists(args.cache):
+        cache = dq_cache.DQStatusCache.load(args.cache)
+    else:
+        cache = dq_cache.DQStatusCache(
+            check_dq_status.DQ_BIT_NAMES,
+            check_dq_status.get_bit_indices(check_dq_status.DQ_BIT_NAMES))
+    stale = cache.stale_files(file_list)
+    for chunk, flags, applied, counts in \
+            check_dq_status.map_dq_checks(stale, cache.bit_indices,
+                                          args.jobs):
+        cache.add(chunk, flags, applied)
+    print "dq_compare.py: read", len(stale), "files,", len(cache), "cached"
+    if args.cache:
+        cache.save(args.cache)
+
+    n_compared, changes, only_a, only_b = compare_passes(cache, args.pass_a,
+                                                         args.pass_b,
+                                                         file_list)
+    if not args.summary:
+        for run, subrun, bits in changes:
+            for name, before, after in bits:
+                print "%10d %4d  %-20s %-11s -> %s" % (run, subrun, name,
+                                                      before, after)
+        for key in only_a:
+            print "%10d %4d  only in pass %d" % (key+(args.pass_a,))
+        for key in only_b:
+            print "%10d %4d  only in pass %d" % (key+(args.pass_b,))
+    for (name, before, after), count in sorted(count_changes(changes).items()):
+        print "%-20s %-11s -> %-11s %6d subruns" % (name, before, after, count)
+    print "dq_compare.py:", n_compared, "subruns in both passes,",
+    print len(changes), "changed;", len(only_a), "only in pass", args.pass_a,
+    print "and", len(only_b), "only in pass", args.pass_b
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+#
+# dq_discovery.py
+#
+# Finds SNOP_<run>_<subrun>[_p<n>] zdab and root files below a directory,
+# optionally using an on-disk index of directory listings that is only
+# refreshed for directories whose mtime has changed
+#
+###############################################################################
+import collections
+import json
+import os
+import re
+import time
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir # backport for python < 3.5
+    except ImportError:
+        scandir = None
+
+# earlier versions of RunDQ wrote later passes as SNOP_<run>_<subrun>__p<n>
+_name_pattern = re.compile(r"^SNOP_([0-9]+)_([0-9]+)(?:__?p([0-9]+))?"
+                           r"\.(zdab|root)$")
+
+DQFile = collections.namedtuple("DQFile", ["path", "run", "subrun",
+                                           "pass_number", "ext"])
+
+def _encode(value):
+    """ Converts the unicode strings in a value loaded from JSON back to
+    utf-8 encoded str
+    """
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    elif isinstance(value, list):
+        return [_encode(item) for item in value]
+    elif isinstance(value, dict):
+        return dict((_encode(key), _encode(item))
+                    for key, item in value.items())
+    return value
+
+def parse_name(path):
+    """ Returns a DQFile describing path, or None if its filename is not of
+    the form SNOP_<run>_<subrun>[_p<n>].zdab/root (or __p<n>, as written
+    by earlier versions). pass_number is None for files without a pass
+    count.
+    """
+    match = _name_pattern.match(os.path.basename(path))
+    if not match:
+        return None
+    run, subrun, pass_number, ext = match.groups()
+    if pass_number is not None:
+        pass_number = int(pass_number)
+    return DQFile(path, int(run), int(subrun), pass_number, ext)
+
+def list_directory(directory):
+    """ Returns lists of the file and subdirectory names in directory """
+    files = []
+    dirs = []
+    if scandir is not None:
+        for entry in scandir(directory):
+            if entry.is_dir():
+                dirs.append(entry.name)
+            else:
+                files.append(entry.name)
+    else:
+        for name in os.listdir(directory):
+            if os.path.isdir(os.path.join(directory, name)):
+                dirs.append(name)
+            else:
+                files.append(name)
+    return files, dirs
+
+class DirectoryIndex(object):
+    """ On-disk cache of directory listings, keyed by directory path. A
+    directory is only listed again if its mtime differs from the cached one.
+    Directories modified within the last few seconds are never cached, since
+    a later change in the same mtime tick would go unnoticed.
+    """
+    _settle_time = 2.0 # seconds
+    def __init__(self, path=None):
+        """ Loads the index stored at path. With path None the index is kept
+        in memory only.
+        """
+        self._path = path
+        self._entries = {}
+        self._modified = False
+        if (path is not None) and os.path.exists(path):
+            try:
+                with open(path, "r") as index_file:
+                    self._entries = _encode(json.load(index_file))
+            except ValueError as detail:
+                print "DirectoryIndex.__init__: warning, ignoring corrupt",
+                print "index", path, detail
+    def list_directory(self, directory):
+        """ As list_directory, but uses the cached listing if directory has
+        not been modified since it was cached
+        """
+        mtime = os.stat(directory).st_mtime
+        entry = self._entries.get(directory)
+        if (entry is None) or (entry["mtime"] != mtime):
+            files, dirs = list_directory(directory)
+            entry = {"mtime": mtime, "files": files, "dirs": dirs}
+            if (time.time()-mtime > self._settle_time):
+                self._entries[directory] = entry
+                self._modified = True
+        return entry["files"], entry["dirs"]
+    def walk(self, top):
+        """ Yields (directory, filenames) for top and every directory below
+        it, in the manner of os.walk
+        """
+        stack = [top]
+        while stack:
+            directory = stack.pop()
+            files, dirs = self.list_directory(directory)
+            yield directory, files
+            stack.extend(os.path.join(directory, name) for name in dirs)
+    def save(self):
+        """ Writes the index to disk if it has changed, replacing the old
+        index atomically
+        """
+        if (self._path is None) or not self._modified:
+            return
+        temp_path = self._path + ".tmp." + str(os.getpid())
+        with open(temp_path, "w") as index_file:
+            json.dump(self._entries, index_file)
+        os.rename(temp_path, self._path)
+        self._modified = False
+
+def find_files(directory, ext, pass_number="any", index_path=None):
+    """ Returns a list of DQFile records for the files below directory with
+    extension ext ("zdab" or "root") and the given pass number, sorted by
+    run and subrun. pass_number may be an integer, None (no pass count, as
+    for raw zdabs) or "any". If index_path is given, directory listings are
+    cached there between calls.
+    """
+    index = DirectoryIndex(index_path)
+    directory = os.path.abspath(directory)
+    records = []
+    for root, files in index.walk(directory):
+        for file in files:
+            record = parse_name(file)
+            if (record is None) or (record.ext != ext):
+                continue
+            if (pass_number != "any") and (record.pass_number != pass_number):
+                continue
+            records.append(record._replace(path=os.path.join(root, file)))
+    index.save()
+    records.sort(key=lambda record: (record.run, record.subrun,
+                                     record.pass_number, record.path))
+    return records
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+#
+# dq_manifest.py
+#
+# Keeps a record, in each output directory, of the files that have already
+# been DQ-processed, so that re-runs only process new or modified inputs
+#
+###############################################################################
+import fcntl
+import hashlib
+import json
+import os
+
+MANIFEST_NAME = ".dq_manifest.json"
+
+def hash_file(path, block_size=1<<20):
+    """ Returns the SHA-1 hex digest of the contents of the file at path """
+    digest = hashlib.sha1()
+    with open(path, "rb") as file_:
+        block = file_.read(block_size)
+        while block:
+            digest.update(block)
+            block = file_.read(block_size)
+    return digest.hexdigest()
+
+class DQManifest(object):
+    """ Manifest of completed DQ passes for a single output directory.
+
+    Entries are keyed by input filename and pass number and hold the input's
+    size, mtime and (optionally) content hash, the hash of the template macro
+    used and the outputs produced.
+    """
+    def __init__(self, directory):
+        """ Loads the manifest stored in directory, if there is one """
+        self._directory = directory
+        self._path = os.path.join(directory, MANIFEST_NAME)
+        self._entries = {}
+        if os.path.exists(self._path):
+            try:
+                with open(self._path, "r") as manifest_file:
+                    self._entries = json.load(manifest_file)
+            except ValueError as detail:
+                print "DQManifest.__init__: warning, ignoring corrupt",
+                print "manifest", self._path, detail
+                self._entries = {}
+    def _key(self, path, pass_number):
+        """ Returns the manifest key for an input path and pass number """
+        return os.path.basename(path) + ":p" + str(pass_number)
+    def _signature(self, path, use_hash):
+        """ Returns a dict describing the current state of the input file """
+        stat = os.stat(path)
+        signature = {"size": stat.st_size, "mtime": stat.st_mtime}
+        if use_hash:
+            signature["hash"] = hash_file(path)
+        return signature
+    def is_complete(self, path, pass_number, macro_hash, use_hash=False):
+        """ Returns True if path has already been processed for pass_number
+        with the same template macro, is unchanged since and all of its
+        outputs still exist.
+        """
+        entry = self._entries.get(self._key(path, pass_number))
+        if entry is None:
+            return False
+        if (entry.get("macro_hash") != macro_hash):
+            return False
+        stat = os.stat(path)
+        if (entry.get("size") != stat.st_size or
+            entry.get("mtime") != stat.st_mtime):
+            return False
+        if use_hash and (entry.get("hash") != hash_file(path)):
+            return False
+        for output in entry.get("outputs", []):
+            if not os.path.exists(output):
+                return False
+        return True
+    def record(self, path, pass_number, macro_hash, outputs, use_hash=False):
+        """ Adds or replaces the manifest entry for path and pass_number """
+        entry = self._signature(path, use_hash)
+        entry["pass"] = pass_number
+        entry["macro_hash"] = macro_hash
+        entry["outputs"] = list(outputs)
+        self._entries[self._key(path, pass_number)] = entry
+    def save(self):
+        """ Writes the manifest to disk. The file is replaced atomically so
+        an interrupted write never leaves a truncated manifest.
+        """
+        temp_path = self._path + ".tmp." + str(os.getpid())
+        with open(temp_path, "w") as manifest_file:
+            json.dump(self._entries, manifest_file, indent=1, sort_keys=True)
+        os.rename(temp_path, self._path)
+
+def record_completed(path, pass_number, macro_hash, outputs, use_hash=False):
+    """ Records a completed file in the manifest of its directory, holding a
+    lock on the manifest so that concurrent workers do not lose each other's
+    entries
+    """
+    directory = os.path.dirname(path)
+    lock_path = os.path.join(directory, MANIFEST_NAME+".lock")
+    with open(lock_path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            manifest = DQManifest(directory)
+            manifest.record(path, pass_number, macro_hash, outputs, use_hash)
+            manifest.save()
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
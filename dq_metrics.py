@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+#
+# dq_metrics.py
+#
+# Opt-in timing and resource instrumentation of the RunDQ stages, written as
+# JSON lines, with a summary command reporting throughput and the slowest
+# stages and subruns
+#
+###############################################################################
+import contextlib
+import fcntl
+import json
+import os
+import resource
+import socket
+import time
+
+import dq_discovery
+
+def get_child_usage():
+    """ Returns the user and system CPU time, in seconds, and the largest
+    resident set size, in bytes, of all terminated child processes
+    """
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime, usage.ru_stime, usage.ru_maxrss*1024
+
+class StageMetrics(object):
+    """ Timings and resource usage for one RAT invocation, covering one file
+    or a batch of files.
+    """
+    def __init__(self, paths, pass_number):
+        """ Starts the record for paths, processed for pass_number """
+        self._start = time.time()
+        self._record = {"host": socket.gethostname(), "pid": os.getpid(),
+                        "pass": pass_number, "start": self._start,
+                        "stages": {}, "files": [], "input_bytes": 0,
+                        "output_bytes": 0}
+        for path in paths:
+            record = dq_discovery.parse_name(path)
+            run, subrun = None, None
+            if record is not None:
+                run, subrun = record.run, record.subrun
+            self._record["files"].append({"path": path, "run": run,
+                                          "subrun": subrun})
+            self._record["input_bytes"] += os.path.getsize(path)
+    @contextlib.contextmanager
+    def stage(self, name):
+        """ Times the enclosed block as stage name: wall time, CPU time of
+        this process and CPU time and peak RSS of children run within it
+        """
+        start = time.time()
+        own_start = resource.getrusage(resource.RUSAGE_SELF)
+        child_start = get_child_usage()
+        try:
+            yield
+        finally:
+            own_end = resource.getrusage(resource.RUSAGE_SELF)
+            child_end = get_child_usage()
+            stage = {"wall": time.time()-start,
+                     "cpu": own_end.ru_utime-own_start.ru_utime
+                     +own_end.ru_stime-own_start.ru_stime}
+            child_cpu = child_end[0]-child_start[0]+child_end[1]-child_start[1]
+            if (child_cpu > 0):
+                stage["child_cpu"] = child_cpu
+            # ru_maxrss is a high-water mark over all children, so it only
+            # describes this stage's children if it rose during the stage
+            if (child_end[2] > child_start[2]):
+                stage["child_max_rss"] = child_end[2]
+            self._record["stages"][name] = stage
+    def set(self, stage, key, value):
+        """ Adds a value to the record of stage, e.g. the events processed """
+        self._record["stages"].setdefault(stage, {})[key] = value
+    def add_outputs(self, paths):
+        """ Adds the sizes of the output files at paths """
+        for path in paths:
+            if os.path.exists(path):
+                self._record["output_bytes"] += os.path.getsize(path)
+    def write(self, path, success):
+        """ Appends the record to the JSON-lines file at path. The file is
+        locked while writing, so concurrent workers can share one file.
+        """
+        self._record["end"] = time.time()
+        self._record["success"] = success
+        line = json.dumps(self._record, sort_keys=True)+"\n"
+        with open(path, "a") as metrics_file:
+            fcntl.flock(metrics_file, fcntl.LOCK_EX)
+            try:
+                metrics_file.write(line)
+                metrics_file.flush()
+            finally:
+                fcntl.flock(metrics_file, fcntl.LOCK_UN)
+
+class NoMetrics(object):
+    """ Stands in for StageMetrics when no metrics are recorded """
+    @contextlib.contextmanager
+    def stage(self, name):
+        yield
+    def set(self, stage, key, value):
+        pass
+    def add_outputs(self, paths):
+        pass
+    def write(self, path, success):
+        pass
+
+def load(path):
+    """ Returns the list of records in the JSON-lines file at path """
+    records = []
+    with open(path, "r") as metrics_file:
+        for line in metrics_file:
+            if line.strip():
+                records.append(json.loads(line))
+    return records
+
+def summarise(records, n_slowest=5):
+    """ Prints throughput, time per stage and the slowest subruns """
+    if not records:
+        print "dq_metrics: no records"
+        return
+    n_files = sum(len(record["files"]) for record in records)
+    n_failed = sum(len(record["files"]) for record in records
+                   if not record["success"])
+    span = max(record["end"] for record in records) \
+        - min(record["start"] for record in records)
+    input_mb = sum(record["input_bytes"] for record in records)/1e6
+    output_mb = sum(record["output_bytes"] for record in records)/1e6
+    print "files:      ", n_files, "("+str(n_failed)+" failed) in",
+    print len(records), "RAT invocations"
+    print "elapsed:     %.1f s" % span
+    if (span > 0):
+        print "throughput:  %.1f files/hour, %.2f MB/s in, %.2f MB/s out" % \
+            (3600.*n_files/span, input_mb/span, output_mb/span)
+    stages = {}
+    for record in records:
+        for name, stage in record["stages"].items():
+            stages.setdefault(name, []).append(stage.get("wall", 0.))
+    print "stage          total (s)   mean (s)    max (s)"
+    for name, walls in sorted(stages.items(), key=lambda item: -sum(item[1])):
+        print "%-12s %11.1f %10.2f %10.2f" % \
+            (name, sum(walls), sum(walls)/len(walls), max(walls))
+    print "slowest RAT invocations:"
+    def rat_time(record):
+        return record["stages"].get("run_rat", {}).get("wall", 0.)
+    for record in sorted(records, key=rat_time, reverse=True)[:n_slowest]:
+        rat = record["stages"].get("run_rat", {})
+        names = ", ".join("%s/%s" % (entry["run"], entry["subrun"])
+                          for entry in record["files"])
+        print "  %8.1f s  %s  events %s  peak RSS %.0f MB" % \
+            (rat_time(record), names, rat.get("events", "?"),
+             (rat.get("peak_rss") or 0)/1e6)
+
+###############################################################################
+if __name__=="__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Summarise RunDQ metrics "
+                                     "written with run_dq.py --metrics")
+    parser.add_argument("metrics", nargs="+", help="JSON-lines metrics files")
+    parser.add_argument("-n", "--slowest", type=int, default=5,
+                        help="number of slowest RAT invocations to list")
+    args = parser.parse_args()
+
+    records = []
+    for path in args.metrics:
+        records += load(path)
+    summarise(records, args.slowest)
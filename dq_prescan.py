@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+#
+# dq_prescan.py
+#
+# Cheap processing-cost estimates for zdab and root inputs, used to
+# schedule the largest files first and to predict when a batch will finish
+#
+###############################################################################
+import heapq
+import json
+import mmap
+import os
+import struct
+
+# zdab files are ZEBRA FZ exchange files: a sequence of physical records,
+# each starting with an 8-word steering block whose first word is the
+# magic number below, holding logical records each starting with a 2-word
+# header (length, type). The steering block gives the offset of the first
+# logical record starting in the physical record, 0 if a large record
+# fills all of it. The first logical record of each data record, one per
+# event apart from a few run-level records, has type 2.
+ZEBRA_MAGIC = 0x0123CDEF
+ZEBRA_STEERING_WORDS = 8
+ZEBRA_LR_START = 2 # first logical record of a data record
+ZEBRA_LR_PADDING = (5, 6) # padding to the end of the physical record
+
+def count_zdab_events(path):
+    """ Estimates the number of events in a zdab file by walking the ZEBRA
+    physical and logical record headers and counting the data records,
+    skipping over their contents, so that only the pages holding headers
+    are read. Run-level records (RHDR, TRIG, ...) are counted too, so the
+    count is high by a few records per file. Returns None if the file is
+    not in the expected format.
+    """
+    size = os.path.getsize(path)
+    if (size == 0):
+        return 0
+    with open(path, "rb") as zdab_file:
+        data = mmap.mmap(zdab_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if (size < 4*ZEBRA_STEERING_WORDS):
+                return None
+            # the byte order is that of the machine that wrote the file
+            for order in [">", "<"]:
+                word = struct.Struct(order+"I")
+                if (word.unpack_from(data, 0)[0] == ZEBRA_MAGIC):
+                    break
+            else:
+                return None
+            steering = struct.Struct(order+"8I")
+            header = struct.Struct(order+"2I")
+            count = 0
+            record = 0 # start of the physical record, in bytes
+            while (record+steering.size <= size):
+                words = steering.unpack_from(data, record)
+                length = words[4] & 0xffffff # in words
+                offset = words[6] # of the first logical record, in words
+                if (words[0] != ZEBRA_MAGIC) or (length == 0) or \
+                        (0 < offset < ZEBRA_STEERING_WORDS):
+                    return None
+                end = min(record+4*length, size)
+                position = record+4*offset
+                if (offset == 0): # continues a record, none starts here
+                    position = end
+                following = record+4*length # continuation of the data
+                if (words[7] == 0):
+                    following += steering.size
+                while (position < end):
+                    if (position+header.size <= end):
+                        lr_length, lr_type = header.unpack_from(data,
+                                                                position)
+                    elif (following+4 <= size):
+                        # the header is split over two physical records
+                        lr_length = word.unpack_from(data, position)[0]
+                        lr_type = word.unpack_from(data, following)[0]
+                    else:
+                        break
+                    if lr_type in ZEBRA_LR_PADDING:
+                        break
+                    if (lr_type == ZEBRA_LR_START):
+                        count += 1
+                    position += 4*(2+lr_length)
+                # skip the fast blocks that follow the physical record
+                record += 4*length*(1+words[7])
+            return count
+        finally:
+            data.close()
+
+class CostCache(object):
+    """ Cost estimates for input files, stored as JSON alongside the
+    directory index. Estimates are reused while a file's size and mtime are
+    unchanged.
+    """
+    def __init__(self, path=None):
+        """ Loads the cache at path; with path None it is in memory only """
+        self._path = path
+        self._entries = {}
+        self._modified = False
+        if (path is not None) and os.path.exists(path):
+            try:
+                with open(path, "r") as cache_file:
+                    self._entries = json.load(cache_file)
+            except ValueError as detail:
+                print "CostCache.__init__: warning, ignoring corrupt cache",
+                print path, detail
+    def estimate(self, path, count_events=False):
+        """ Returns a dict with the size and mtime of path and, if
+        count_events is True and path is a zdab, its estimated event count
+        (None if it could not be counted)
+        """
+        stat = os.stat(path)
+        entry = self._entries.get(path)
+        if (entry is None) or (entry["size"] != stat.st_size) or \
+                (entry["mtime"] != stat.st_mtime) or \
+                (count_events and ("events" not in entry)):
+            entry = {"size": stat.st_size, "mtime": stat.st_mtime}
+            if count_events and path.endswith(".zdab"):
+                entry["events"] = count_zdab_events(path)
+            self._entries[path] = entry
+            self._modified = True
+        return entry
+    def save(self):
+        """ Writes the cache to disk, if it has changed """
+        if (self._path is None) or not self._modified:
+            return
+        temp_path = self._path + ".tmp." + str(os.getpid())
+        with open(temp_path, "w") as cache_file:
+            json.dump(self._entries, cache_file)
+        os.rename(temp_path, self._path)
+        self._modified = False
+
+def has_events(estimate):
+    """ Returns True if estimate holds an event count """
+    return estimate.get("events") is not None
+
+def get_cost(estimate, use_events):
+    """ Returns the cost of a file from its estimate: the event count if
+    use_events is True, otherwise the size in bytes. Costs of different
+    files are only comparable if they are all in the same unit, so callers
+    should only set use_events if every estimate has_events.
+    """
+    if use_events:
+        return estimate["events"]
+    return estimate["size"]
+
+def order_largest_first(items, costs):
+    """ Returns items sorted by decreasing cost, i.e. longest processing
+    time first. costs holds the cost of each item.
+    """
+    order = sorted(range(len(items)), key=lambda index: -costs[index])
+    return [items[index] for index in order]
+
+def predict_makespan(costs, jobs, rate):
+    """ Predicts the time, in seconds, for jobs workers to process items of
+    the given costs dispatched largest first, each worker taking the next
+    item as soon as it is free. rate is the cost processed per second by
+    one worker.
+    """
+    finish_times = [0.]*max(jobs, 1)
+    for cost in sorted(costs, reverse=True):
+        heapq.heapreplace(finish_times, finish_times[0]+cost/float(rate))
+    return max(finish_times)
+
+def rates_from_metrics(metrics_path):
+    """ Returns the bytes and events processed per second of RAT time, per
+    worker, from the records written by run_dq.py --metrics, as a tuple.
+    Either is None if it cannot be determined.
+    """
+    import dq_metrics
+    seconds = 0.
+    input_bytes = 0
+    events = 0
+    for record in dq_metrics.load(metrics_path):
+        rat = record["stages"].get("run_rat", {})
+        if record["success"] and rat.get("wall"):
+            seconds += rat["wall"]
+            input_bytes += record["input_bytes"]
+            events += rat.get("events") or 0
+    if (seconds <= 0):
+        return None, None
+    return (input_bytes/seconds or None), (events/seconds or None)
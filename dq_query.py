@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+#
+# dq_query.py
+#
+# Headless queries of DQ check outcomes from the columnar cache written by
+# check_dq_status.py -c: pass/fail summaries, per-bit counts and lists of
+# failing subruns, as plain text or JSON for shell pipelines and monitoring.
+# ROOT and RAT are only loaded if files have to be read to update the cache.
+#
+###############################################################################
+import os
+import sys
+
+# run without sourcing env.sh: find the other DQ modules next to this one
+_dq_dir = os.path.dirname(os.path.abspath(__file__))
+for _path in [_dq_dir, os.path.join(_dq_dir, "utils")]:
+    if _path not in sys.path:
+        sys.path.append(_path)
+
+import numpy
+
+import bit_manips
+import dq_cache
+import dq_compare
+
+def select_rows(cache, pass_number=None, first_run=None, last_run=None):
+    """ Returns the indices of the cache rows to query: one per subrun and
+    pass (see dq_compare.index_pass), only for pass_number if it is given
+    and only for runs in [first_run, last_run] if these are given, sorted
+    by run, subrun and pass
+    """
+    if (pass_number is None):
+        passes = numpy.unique(cache.pass_number)
+    else:
+        passes = [pass_number]
+    rows = []
+    for each_pass in passes:
+        rows += dq_compare.index_pass(cache, each_pass).values()
+    rows = numpy.array(rows, dtype=numpy.int64)
+    if (first_run is not None):
+        rows = rows[cache.run[rows] >= first_run]
+    if (last_run is not None):
+        rows = rows[cache.run[rows] <= last_run]
+    order = numpy.lexsort((cache.pass_number[rows], cache.subrun[rows],
+                           cache.run[rows]))
+    return rows[order]
+
+def get_failing(cache, rows, bit_names=None):
+    """ Returns a boolean matrix, of shape (rows, bits), of the checks that
+    were applied and failed, for the named bits or all cached bits
+    """
+    if bit_names is None:
+        bit_names = cache.bit_names
+    bit_index = dict(zip(cache.bit_names, cache.bit_indices))
+    passed, failed, not_applied = bit_manips.query_masks(
+        cache.flags[rows], cache.applied[rows], bit_names, bit_index)
+    return failed
+
+def summarise(cache, rows):
+    """ Returns a dict of the number of subruns queried, passing every
+    applied check and failing at least one
+    """
+    failing = get_failing(cache, rows).any(axis=1)
+    return {"subruns": len(rows), "passed": int((~failing).sum()),
+            "failed": int(failing.sum())}
+
+def count_bits(cache, rows):
+    """ Returns a list of (bit name, passed, failed, not applied) counts """
+    counts = bit_manips.count_masks(cache.flags[rows], cache.applied[rows],
+                                    cache.bit_indices)
+    return [(name, int(counts[0][bit]), int(counts[1][bit]),
+             int(counts[2][bit]))
+            for bit, name in enumerate(cache.bit_names)]
+
+def list_failing(cache, rows, bit_names=None):
+    """ Returns a list of (run, subrun, pass, [failed bit names]) for the
+    subruns in which any of the named bits (default: all) failed
+    """
+    if bit_names is None:
+        bit_names = cache.bit_names
+    failing = get_failing(cache, rows, bit_names)
+    return [(int(cache.run[row]), int(cache.subrun[row]),
+             int(cache.pass_number[row]),
+             [bit_names[bit] for bit in numpy.nonzero(failing[entry])[0]])
+            for entry, row in enumerate(rows) if failing[entry].any()]
+
+def update_cache(cache, directory, pass_number, jobs):
+    """ Reads any new or modified DQ-processed root files below directory
+    into cache. Only this loads RAT and ROOT, and only if there are files
+    to read. Returns the number of files read.
+    """
+    import check_dq_status
+    import dq_discovery
+    file_list = [record.path for record in
+                 dq_discovery.find_files(directory, "root",
+                                         pass_number or "any")
+                 if record.pass_number is not None]
+    stale = cache.stale_files(file_list)
+    for chunk, flags, applied, counts in \
+            check_dq_status.map_dq_checks(stale, cache.bit_indices, jobs):
+        cache.add(chunk, flags, applied)
+    return len(stale)
+
+###############################################################################
+if __name__=="__main__":
+    import argparse
+    import json
+    import signal
+
+    # exit quietly when the output is piped into e.g. head
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+    parser = argparse.ArgumentParser(description="Query DQ check outcomes "
+                                     "from a check_dq_status.py cache")
+    parser.add_argument("cache", help="columnar (.npz) cache of DQ words")
+    parser.add_argument("query", choices=["summary", "bits", "failing"],
+                        help="summary: subruns passing/failing; bits: "
+                        "per-check counts; failing: subruns with failed "
+                        "checks")
+    parser.add_argument("-p", "--passnum", type=int,
+                        help="only query this pass")
+    parser.add_argument("--first-run", type=int, help="only query runs from "
+                        "this one on")
+    parser.add_argument("--last-run", type=int, help="only query runs up to "
+                        "this one")
+    parser.add_argument("-b", "--bit", action="append",
+                        help="with failing, only consider this check "
+                        "(may be repeated)")
+    parser.add_argument("--json", action="store_true",
+                        help="print the result as JSON")
+    parser.add_argument("--check", action="store_true",
+                        help="exit with status 1 if any queried subrun "
+                        "failed a check, e.g. for monitoring")
+    parser.add_argument("-u", "--update", metavar="DIRECTORY",
+                        help="first read new or modified DQ-processed files "
+                        "below DIRECTORY into the cache (loads ROOT/RAT)")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="with --update, number of processes reading "
+                        "files")
+    args = parser.parse_args()
+
+    try:
+        assert os.path.exists(args.cache), "no cache "+args.cache+ \
+            ", create it with check_dq_status.py -c"
+        cache = dq_cache.DQStatusCache.load(args.cache)
+        for name in args.bit or []:
+            assert name in cache.bit_names, "unknown check "+name
+    except AssertionError as detail:
+        print >> sys.stderr, "dq_query.py: error", detail
+        sys.exit(2)
+    if args.update:
+        if update_cache(cache, args.update, args.passnum, args.jobs):
+            cache.save(args.cache)
+    rows = select_rows(cache, args.passnum, args.first_run, args.last_run)
+
+    if (args.query == "summary"):
+        result = summarise(cache, rows)
+        n_failed = result["failed"]
+        if not args.json:
+            print "subruns %d passed %d failed %d" % \
+                (result["subruns"], result["passed"], result["failed"])
+    elif (args.query == "bits"):
+        result = count_bits(cache, rows)
+        n_failed = summarise(cache, rows)["failed"]
+        if not args.json:
+            for name, passed, failed, not_applied in result:
+                print "%-20s %8d %8d %8d" % (name, passed, failed,
+                                             not_applied)
+        result = [dict(zip(["bit", "passed", "failed", "not_applied"],
+                           counts)) for counts in result]
+    else:
+        result = list_failing(cache, rows, args.bit)
+        n_failed = len(result)
+        if not args.json:
+            for run, subrun, pass_number, bits in result:
+                print "%d\t%d\t%d\t%s" % (run, subrun, pass_number,
+                                          ",".join(bits))
+        result = [dict(zip(["run", "subrun", "pass", "failed"], entry))
+                  for entry in result]
+    if args.json:
+        print json.dumps(result, sort_keys=True)
+    if args.check and n_failed:
+        sys.exit(1)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+#
+# dq_queue.py
+#
+# Work queue of files to DQ-process, kept in an SQLite database on shared
+# storage, from which any number of run_dq.py workers on any host claim
+# files under time-limited leases
+#
+###############################################################################
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+_schema = """
+CREATE TABLE IF NOT EXISTS items (
+    path TEXT NOT NULL,
+    pass INTEGER NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    message TEXT,
+    outputs TEXT,
+    updated REAL,
+    PRIMARY KEY (path, pass)
+);
+CREATE INDEX IF NOT EXISTS items_state ON items (state, lease_expires);
+"""
+
+def get_worker_id():
+    """ Returns an identifier for this process, unique across hosts """
+    return socket.gethostname()+":"+str(os.getpid())
+
+class WorkQueue(object):
+    """ Queue of (path, pass) items. Each item is pending, leased to a
+    worker until its lease expires, done or failed. Leased items whose lease
+    has expired, e.g. because the worker died, are claimed again by the next
+    worker, up to max_attempts times.
+
+    SQLite relies on file locking, so the queue file must be on storage with
+    working POSIX locks (e.g. NFSv4 or Lustre with locking enabled).
+    """
+    def __init__(self, path, timeout=60.0):
+        """ Opens, creating if necessary, the queue database at path """
+        self._path = path
+        self._connection = sqlite3.connect(path, timeout=timeout,
+                                           isolation_level=None)
+        self._connection.executescript(_schema)
+    def close(self):
+        self._connection.close()
+    def add(self, paths, pass_number):
+        """ Adds items for paths that are not already queued for this pass.
+        Returns the number of items added.
+        """
+        cursor = self._connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            before = cursor.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+            cursor.executemany("INSERT OR IGNORE INTO items (path, pass, "
+                               "updated) VALUES (?, ?, ?)",
+                               [(path, pass_number, time.time())
+                                for path in paths])
+            after = cursor.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+            cursor.execute("COMMIT")
+        except:
+            cursor.execute("ROLLBACK")
+            raise
+        return after-before
+    def claim(self, worker, lease_time, max_attempts=3):
+        """ Leases the next pending (or expired) item to worker for
+        lease_time seconds. Returns its (path, pass) or None if there is no
+        work left to claim. Items whose lease expired on their last allowed
+        attempt are marked failed.
+        """
+        now = time.time()
+        cursor = self._connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE") # take the write lock before reading
+        try:
+            cursor.execute(
+                "UPDATE items SET state = 'failed', message = 'lease expired "
+                "on final attempt', lease_expires = NULL, updated = ? WHERE "
+                "state = 'leased' AND lease_expires < ? AND attempts >= ?",
+                (now, now, max_attempts))
+            row = cursor.execute(
+                "SELECT rowid, path, pass FROM items WHERE attempts < ? AND "
+                "(state = 'pending' OR (state = 'leased' AND "
+                "lease_expires < ?)) ORDER BY rowid LIMIT 1",
+                (max_attempts, now)).fetchone()
+            if row is not None:
+                cursor.execute(
+                    "UPDATE items SET state = 'leased', worker = ?, "
+                    "lease_expires = ?, attempts = attempts + 1, updated = ? "
+                    "WHERE rowid = ?", (worker, now+lease_time, now, row[0]))
+            cursor.execute("COMMIT")
+        except:
+            cursor.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        return row[1].encode("utf-8"), row[2]
+    def renew(self, path, pass_number, worker, lease_time):
+        """ Extends worker's lease on an item. Returns False if the lease
+        has been lost to another worker.
+        """
+        now = time.time()
+        cursor = self._connection.execute(
+            "UPDATE items SET lease_expires = ?, updated = ? WHERE path = ? "
+            "AND pass = ? AND state = 'leased' AND worker = ?",
+            (now+lease_time, now, path, pass_number, worker))
+        return cursor.rowcount == 1
+    def complete(self, path, pass_number, worker, success, message="",
+                 outputs=()):
+        """ Records the result of processing an item. Returns False, and
+        records nothing, if worker no longer holds the lease.
+        """
+        state = "done" if success else "failed"
+        cursor = self._connection.execute(
+            "UPDATE items SET state = ?, message = ?, outputs = ?, "
+            "lease_expires = NULL, updated = ? WHERE path = ? AND pass = ? "
+            "AND state = 'leased' AND worker = ?",
+            (state, message, json.dumps(list(outputs)), time.time(), path,
+             pass_number, worker))
+        return cursor.rowcount == 1
+    def reset_failed(self, pass_number):
+        """ Returns failed items of pass_number to pending, with their
+        attempt counts cleared. Returns the number of items reset.
+        """
+        cursor = self._connection.execute(
+            "UPDATE items SET state = 'pending', attempts = 0, updated = ? "
+            "WHERE pass = ? AND state = 'failed'", (time.time(), pass_number))
+        return cursor.rowcount
+    def counts(self, pass_number):
+        """ Returns a dict of the number of items in each state """
+        rows = self._connection.execute(
+            "SELECT state, COUNT(*) FROM items WHERE pass = ? GROUP BY state",
+            (pass_number,)).fetchall()
+        return dict(rows)
+    def failures(self, pass_number):
+        """ Returns (path, message) for each failed item of pass_number """
+        return self._connection.execute(
+            "SELECT path, message FROM items WHERE pass = ? AND "
+            "state = 'failed' ORDER BY path", (pass_number,)).fetchall()
+
+class LeaseKeeper(threading.Thread):
+    """ Renews a lease in the background while its item is processed """
+    def __init__(self, queue_path, path, pass_number, worker, lease_time):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._args = (path, pass_number, worker, lease_time)
+        self._queue_path = queue_path
+        self._interval = lease_time/3.
+        self._done = threading.Event()
+        self.lost = False
+    def run(self):
+        # sqlite connections cannot be shared between threads
+        queue = WorkQueue(self._queue_path)
+        try:
+            while not self._done.wait(self._interval):
+                if not queue.renew(*self._args):
+                    print "LeaseKeeper: warning, lease lost on", self._args[0]
+                    self.lost = True
+                    return
+        finally:
+            queue.close()
+    def stop(self):
+        self._done.set()
+        self.join()
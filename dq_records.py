@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+#
+# dq_records.py
+#
+# Consolidated store for DATAQUALITY_RECORDS files: the records of each run
+# are appended, compressed, to a single file, with an SQLite index by run,
+# subrun, pass and version, in place of one small file per record in
+# $RECORDS
+#
+###############################################################################
+import os
+import re
+import sqlite3
+import time
+import zlib
+
+import file_manips
+
+INDEX_NAME = "records.sqlite"
+
+# Names given to records files by RunDQ.clean_up (see file_manips.copy_file)
+_name_pattern = re.compile(r"^DATAQUALITY_RECORDS_([0-9]+)(?:_p([0-9]+))?"
+                           r"(?:_q([0-9]+))?\..+$")
+
+_schema = """
+CREATE TABLE IF NOT EXISTS records (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    run INTEGER NOT NULL,
+    subrun INTEGER,
+    pass INTEGER,
+    version INTEGER,
+    data_file TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    crc INTEGER NOT NULL,
+    ingested REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS records_key ON records (run, subrun, pass, version);
+"""
+
+_columns = ["id", "name", "run", "subrun", "pass", "version", "data_file",
+            "offset", "length", "size", "crc", "ingested"]
+
+def parse_name(name):
+    """ Returns the (run, pass, version) of a records file name, with None
+    for a pass or version the name does not contain, or None if name is not
+    a records file name
+    """
+    match = _name_pattern.match(name)
+    if not match:
+        return None
+    return tuple(None if group is None else int(group)
+                 for group in match.groups())
+
+def compress(data):
+    """ Returns data as a single gzip member, so that a store's data files
+    are themselves valid gzip files (readable with zcat)
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16+zlib.MAX_WBITS)
+    return compressor.compress(data)+compressor.flush()
+
+def decompress(member):
+    """ Returns the data in a gzip member written by compress """
+    return zlib.decompressobj(16+zlib.MAX_WBITS).decompress(member)
+
+class RecordStore(object):
+    """ Append-only store of records files in directory. The records of run
+    r are gzip members appended to records_<r>.gz; the index locates each by
+    offset and length and keeps the name it has, or would have had, in the
+    per-file $RECORDS layout, so that the layout can be exported again.
+
+    Any number of processes may add records at once: the index's write lock
+    is held while a record is appended, so the store must be on storage with
+    working POSIX locks.
+    """
+    def __init__(self, directory, timeout=60.0):
+        """ Opens, creating if necessary, the store in directory """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._directory = directory
+        self._connection = sqlite3.connect(os.path.join(directory, INDEX_NAME),
+                                           timeout=timeout,
+                                           isolation_level=None)
+        self._connection.executescript(_schema)
+    def close(self):
+        self._connection.close()
+    def _row(self, values):
+        row = dict(zip(_columns, values))
+        row["name"] = row["name"].encode("utf-8")
+        row["data_file"] = row["data_file"].encode("utf-8")
+        return row
+    def add(self, file_name, data, subrun=None, pass_number=None,
+            version=None):
+        """ Adds the contents, data, of a records file called file_name.
+        The run, and the pass and version if they are not given, are taken
+        from the name. Nothing is added if the same contents are already
+        stored for the same subrun and pass or, if subrun is None, under the
+        same name. Otherwise, if the name is taken, the record is renamed as
+        file_manips.copy_file would have renamed it. Returns the name the
+        record is stored under.
+        """
+        parsed = parse_name(file_name)
+        if parsed is None:
+            raise ValueError("RecordStore.add: not a records file name, "
+                             +file_name)
+        run = parsed[0]
+        if (pass_number is None):
+            pass_number = parsed[1]
+        crc = zlib.crc32(data) & 0xffffffff
+        cursor = self._connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE") # one writer appends at a time
+        try:
+            if (subrun is not None):
+                duplicate = cursor.execute(
+                    "SELECT name FROM records WHERE run = ? AND subrun = ? "
+                    "AND pass IS ? AND size = ? AND crc = ?",
+                    (run, subrun, pass_number, len(data), crc)).fetchone()
+            else:
+                duplicate = cursor.execute(
+                    "SELECT name FROM records WHERE name = ? AND size = ? AND "
+                    "crc = ?", (file_name, len(data), crc)).fetchone()
+            if (duplicate is not None):
+                cursor.execute("COMMIT")
+                return duplicate[0].encode("utf-8")
+            names = set(row[0] for row in cursor.execute(
+                    "SELECT name FROM records WHERE run = ?", (run,)))
+            if (file_name in names):
+                file_name = file_manips.versioned_name(
+                    file_name, pass_number or 1, existing=names)
+                file_name = file_name.encode("utf-8")
+                parsed = parse_name(file_name)
+            if (version is None):
+                version = parsed[2]
+            data_file = "records_"+str(run)+".gz"
+            member = compress(data)
+            with open(os.path.join(self._directory, data_file), "ab") \
+                    as output:
+                output.seek(0, os.SEEK_END)
+                offset = output.tell()
+                output.write(member)
+                output.flush()
+                os.fsync(output.fileno())
+            cursor.execute("INSERT INTO records (name, run, subrun, pass, "
+                           "version, data_file, offset, length, size, crc, "
+                           "ingested) "
+                           "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                           (file_name, run, subrun, pass_number, version,
+                            data_file, offset, len(member), len(data), crc,
+                            time.time()))
+            cursor.execute("COMMIT")
+        except:
+            cursor.execute("ROLLBACK")
+            raise
+        return file_name
+    def ingest_file(self, path, subrun=None, pass_number=None, remove=False):
+        """ Adds the records file at path, see add, removing it afterwards
+        if remove is True. Returns the name it is stored under.
+        """
+        with open(path, "rb") as records_file:
+            data = records_file.read()
+        name = self.add(os.path.basename(path), data, subrun, pass_number)
+        if remove:
+            os.remove(path)
+        return name
+    def ingest_directory(self, directory, remove=False):
+        """ Adds every records file in directory, e.g. $RECORDS, one at a
+        time. Returns the number of files ingested.
+        """
+        count = 0
+        for name in sorted(os.listdir(directory)):
+            if (parse_name(name) is not None):
+                self.ingest_file(os.path.join(directory, name), remove=remove)
+                count += 1
+        return count
+    def find(self, run=None, subrun=None, pass_number=None, version=None,
+             name=None):
+        """ Returns the index rows, as dicts, of the records matching all of
+        the arguments given, ordered by run and position in the data file
+        """
+        conditions = []
+        values = []
+        for column, value in [("run", run), ("subrun", subrun),
+                              ("pass", pass_number), ("version", version),
+                              ("name", name)]:
+            if (value is not None):
+                conditions.append(column+" = ?")
+                values.append(value)
+        query = "SELECT "+", ".join(_columns)+" FROM records"
+        if conditions:
+            query += " WHERE "+" AND ".join(conditions)
+        query += " ORDER BY run, offset"
+        return [self._row(row) for row in
+                self._connection.execute(query, values)]
+    def read(self, row):
+        """ Returns the contents of the record described by an index row """
+        with open(os.path.join(self._directory, row["data_file"]), "rb") \
+                as data_file:
+            data_file.seek(row["offset"])
+            return decompress(data_file.read(row["length"]))
+    def get(self, run, subrun=None, pass_number=None, version=None):
+        """ Returns the index row and contents of the latest record (highest
+        version, then most recently added) matching the arguments, or None
+        """
+        rows = self.find(run, subrun, pass_number, version)
+        if not rows:
+            return None
+        row = max(rows, key=lambda row: (row["version"] or 0, row["id"]))
+        return row, self.read(row)
+    def scan(self, run=None, pass_number=None):
+        """ Yields the index row and contents of every record, optionally
+        only those of one run or pass, reading each data file in order
+        """
+        data_file = None
+        try:
+            for row in self.find(run, pass_number=pass_number):
+                if (data_file is None) or \
+                        (data_file.name != os.path.join(self._directory,
+                                                        row["data_file"])):
+                    if data_file is not None:
+                        data_file.close()
+                    data_file = open(os.path.join(self._directory,
+                                                  row["data_file"]), "rb")
+                data_file.seek(row["offset"])
+                yield row, decompress(data_file.read(row["length"]))
+        finally:
+            if data_file is not None:
+                data_file.close()
+    def export(self, directory, run=None, overwrite=False):
+        """ Writes records back out as files in directory, under the names
+        they have in the per-file layout. Existing files are only replaced
+        if overwrite is True. Returns the number of files written.
+        """
+        count = 0
+        for row, data in self.scan(run):
+            target = os.path.join(directory, row["name"])
+            if os.path.exists(target) and not overwrite:
+                print "RecordStore.export: warning, skipping existing", target
+                continue
+            temp_path = target+".tmp."+str(os.getpid())
+            with open(temp_path, "wb") as output:
+                output.write(data)
+            os.rename(temp_path, target)
+            count += 1
+        return count
+
+###############################################################################
+if __name__=="__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="Consolidated store of DQ "
+                                     "records files")
+    parser.add_argument("store", help="store directory")
+    commands = parser.add_subparsers(dest="command")
+    ingest = commands.add_parser("ingest", help="add the records files in a "
+                                 "directory, e.g. $RECORDS")
+    ingest.add_argument("directory")
+    ingest.add_argument("--remove", action="store_true",
+                        help="remove each file once it is stored")
+    get = commands.add_parser("get", help="print the latest record of a run")
+    get.add_argument("run", type=int)
+    get.add_argument("-s", "--subrun", type=int)
+    get.add_argument("-p", "--passnum", type=int)
+    get.add_argument("-q", "--version", type=int)
+    listing = commands.add_parser("list", help="list stored records")
+    listing.add_argument("-r", "--run", type=int)
+    listing.add_argument("-p", "--passnum", type=int)
+    export = commands.add_parser("export", help="write records back out as "
+                                 "one file each")
+    export.add_argument("directory")
+    export.add_argument("-r", "--run", type=int)
+    export.add_argument("-o", "--overwrite", action="store_true")
+    args = parser.parse_args()
+
+    store = RecordStore(args.store)
+    if (args.command == "ingest"):
+        print "dq_records.py: ingested",
+        print store.ingest_directory(args.directory, args.remove), "files"
+    elif (args.command == "get"):
+        record = store.get(args.run, args.subrun, args.passnum, args.version)
+        if record is None:
+            print "dq_records.py: no matching record"
+            sys.exit(1)
+        sys.stdout.write(record[1])
+    elif (args.command == "list"):
+        for row in store.find(args.run, pass_number=args.passnum):
+            print "%-45s run %d subrun %s pass %s version %s %d bytes" % \
+                (row["name"], row["run"], row["subrun"], row["pass"],
+                 row["version"], row["size"])
+    elif (args.command == "export"):
+        print "dq_records.py: exported",
+        print store.export(args.directory, args.run, args.overwrite), "files"
+    store.close()
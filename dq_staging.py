@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+#
+# dq_staging.py
+#
+# Staging of DQ inputs to node-local scratch space: upcoming inputs are
+# copied in by a background thread while RAT processes the current one, and
+# outputs are moved back to their destinations by another, so that network
+# file system I/O overlaps with processing
+#
+###############################################################################
+import os
+import Queue
+import shutil
+import tempfile
+import threading
+
+import file_manips
+
+class Stager(threading.Thread):
+    """ Copies inputs, in the order given, into private directories below
+    scratch_dir. At most prefetch inputs are staged ahead of the one in use,
+    and staged inputs never take up more than max_bytes in total; an input
+    larger than max_bytes on its own is not staged at all. Staged inputs
+    keep their file name, so RAT outputs written beside them keep the names
+    they would have had.
+    """
+    def __init__(self, paths, scratch_dir, max_bytes, prefetch=2):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._paths = list(paths)
+        self._scratch_dir = tempfile.mkdtemp(prefix="dq_stage_",
+                                             dir=scratch_dir)
+        self._max_bytes = max_bytes
+        self._prefetch = prefetch
+        self._condition = threading.Condition()
+        self._staged = {} # path: (local path, bytes reserved), None if not
+        self._used_bytes = 0
+        self._in_use = 0 # staged inputs acquired but not yet released
+        self._stopped = False
+    def _wait_for_space(self, size):
+        """ Waits, holding the condition, until an input of size bytes may
+        be staged. Returns False if the stager has been stopped.
+        """
+        while not self._stopped:
+            waiting = len(self._staged)-self._in_use
+            if (waiting < max(self._prefetch, 1)) and \
+                    (self._used_bytes+size <= self._max_bytes):
+                return True
+            self._condition.wait()
+        return False
+    def run(self):
+        for index, path in enumerate(self._paths):
+            try:
+                size = os.path.getsize(path)
+            except OSError: # leave the error to whoever reads it
+                size = self._max_bytes+1
+            with self._condition:
+                if (size > self._max_bytes):
+                    self._staged[path] = None
+                    self._condition.notify_all()
+                    continue
+                if not self._wait_for_space(size):
+                    return
+                self._used_bytes += size
+            local_dir = os.path.join(self._scratch_dir, str(index))
+            local_path = os.path.join(local_dir, os.path.basename(path))
+            try:
+                os.mkdir(local_dir)
+                shutil.copyfile(path, local_path+".part")
+                os.rename(local_path+".part", local_path)
+                staged = (local_path, size)
+            except (IOError, OSError) as detail:
+                print "Stager.run: warning, could not stage", path, detail
+                shutil.rmtree(local_dir, ignore_errors=True)
+                staged = None
+            with self._condition:
+                if staged is None:
+                    self._used_bytes -= size
+                self._staged[path] = staged
+                self._condition.notify_all()
+    def acquire(self, path):
+        """ Waits for path to be staged and returns the local copy, or path
+        itself if it could not be staged
+        """
+        with self._condition:
+            while (path not in self._staged) and not self._stopped:
+                self._condition.wait()
+            staged = self._staged.get(path)
+            if staged is None:
+                self._staged.pop(path, None)
+                return path
+            self._in_use += 1
+            return staged[0]
+    def release(self, path):
+        """ Deletes the staged copy of path and anything written beside it,
+        freeing its space for the next inputs
+        """
+        with self._condition:
+            staged = self._staged.pop(path, None)
+            if staged is None:
+                return
+            self._in_use -= 1
+        shutil.rmtree(os.path.dirname(staged[0]), ignore_errors=True)
+        with self._condition:
+            self._used_bytes -= staged[1]
+            self._condition.notify_all()
+    def stop(self):
+        """ Stops staging and removes the scratch directory """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self.join()
+        shutil.rmtree(self._scratch_dir, ignore_errors=True)
+
+class Flusher(threading.Thread):
+    """ Moves local outputs to their destinations in the background. Each
+    item is moved atomically, replacing any existing file, and a callback is
+    run once all of an item's files have been moved.
+    """
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._queue = Queue.Queue()
+        self.errors = {} # key: error message, for items that failed
+    def flush(self, key, moves, callback=None):
+        """ Queues the (local path, destination) pairs in moves. callback,
+        if given, is called with key once they have been moved or failed.
+        """
+        self._queue.put((key, moves, callback))
+    def run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            key, moves, callback = item
+            try:
+                for local_path, destination in moves:
+                    file_manips.place_file(local_path, destination,
+                                           replace=True)
+            except (IOError, OSError) as detail:
+                self.errors[key] = "could not flush output, "+str(detail)
+            finally:
+                if callback is not None:
+                    callback(key)
+    def finish(self):
+        """ Waits until all queued outputs have been moved """
+        self._queue.put(None)
+        self.join()
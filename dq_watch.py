@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+#
+# dq_watch.py
+#
+# Watches an incoming data directory for newly completed subrun files, for
+# nearline DQ processing with run_dq.py --watch. Uses inotify, through
+# pyinotify, to wake up as soon as files change if it is available, and
+# otherwise polls.
+#
+###############################################################################
+import os
+import time
+
+import dq_discovery
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+class DirectoryWatcher(object):
+    """ Finds files below a directory that have finished being written. A
+    file is complete once a marker file (its name plus marker_suffix) exists
+    beside it, or once it has not been modified for settle_time seconds and
+    its size is unchanged since the previous poll.
+
+    inotify events only cause an early poll: completeness is always judged
+    from the directory contents, so events missed while busy (or on file
+    systems without inotify support, such as NFS) are caught by the next
+    poll.
+    """
+    def __init__(self, directory, ext, pass_number, settle_time=30.,
+                 poll_interval=10., marker_suffix=".done", index_path=None,
+                 use_inotify=True):
+        """ Watches directory for files with extension ext and pass number
+        pass_number, as for dq_discovery.find_files
+        """
+        self._directory = os.path.abspath(directory)
+        self._ext = ext
+        self._pass_number = pass_number
+        self._settle_time = settle_time
+        self._poll_interval = poll_interval
+        self._marker_suffix = marker_suffix
+        self._index_path = index_path
+        self._sizes = {}
+        self._seen = set()
+        self._notifier = None
+        if use_inotify and (pyinotify is not None):
+            manager = pyinotify.WatchManager()
+            self._notifier = pyinotify.Notifier(manager, lambda event: None)
+            manager.add_watch(self._directory, pyinotify.IN_CLOSE_WRITE |
+                              pyinotify.IN_MOVED_TO | pyinotify.IN_CREATE,
+                              rec=True, auto_add=True)
+    def uses_inotify(self):
+        return self._notifier is not None
+    def close(self):
+        if self._notifier is not None:
+            self._notifier.stop()
+            self._notifier = None
+    def _is_complete(self, path, now):
+        """ Returns True if path has finished being written """
+        if os.path.exists(path+self._marker_suffix):
+            return True
+        try:
+            stat = os.stat(path)
+        except OSError: # removed since it was listed
+            return False
+        previous = self._sizes.get(path)
+        self._sizes[path] = stat.st_size
+        if (now-stat.st_mtime < self._settle_time):
+            return False
+        return (previous is None) or (previous == stat.st_size)
+    def poll(self, limit=None, skip=None):
+        """ Returns the paths of files that have become complete since the
+        last poll, ordered by run and subrun. Each file is returned once.
+        At most limit paths are returned, if it is given; later files are
+        left for the next polls. Complete files for which skip(path) is True
+        are passed over without counting towards limit.
+        """
+        now = time.time()
+        complete = []
+        for record in dq_discovery.find_files(self._directory, self._ext,
+                                              self._pass_number,
+                                              self._index_path):
+            if (limit is not None) and (len(complete) >= limit):
+                break
+            if (record.path in self._seen):
+                continue
+            if self._is_complete(record.path, now):
+                self._seen.add(record.path)
+                self._sizes.pop(record.path, None)
+                if (skip is None) or not skip(record.path):
+                    complete.append(record.path)
+        return complete
+    def get_interval(self):
+        """ Returns the seconds until the directory should next be polled:
+        the poll interval, or the settle time if it is shorter and files are
+        still settling
+        """
+        if self._sizes:
+            return min(self._poll_interval, self._settle_time)
+        return self._poll_interval
+    def wait(self, timeout=None):
+        """ Sleeps until files below the directory change (with inotify) or
+        for timeout seconds, which defaults to get_interval()
+        """
+        if timeout is None:
+            timeout = self.get_interval()
+        if self._notifier is None:
+            time.sleep(timeout)
+        elif self._notifier.check_events(int(timeout*1000)):
+            self._notifier.read_events()
+            self._notifier.process_events()
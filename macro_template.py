@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+#
+# macro_template.py
+#
+# Parses a RAT processing macro template once into a compiled form, with
+# named slots for the input source and output file, so that macros for many
+# files can be rendered in memory
+#
+###############################################################################
+import os
+
+_templates = {} # compiled templates, keyed by path
+
+class MacroTemplate(object):
+    """ A compiled RAT macro template.
+
+    The template is split into literal text and three slots: "source",
+    which replaces the /rat/inzdab/read_default line with a read command for
+    the input file, "output", which follows the /rat/proclast outroot line
+    with a /rat/procset file command for the output Root file, and
+    "processors", the /rat/proc lines (and their settings) before
+    /rat/proclast outroot, which are repeated to chain several passes.
+    Templates without /rat/proclast outroot have no processors slot, and
+    cannot be chained.
+    """
+    def __init__(self, path):
+        """ Reads and compiles the template at path """
+        self._path = path
+        self._segments = [] # literal strings and slot names
+        self._zdab_command = "/rat/inzdab/read"
+        self._processors = None
+        literal = []
+        processors_start = None # index in literal of the first /rat/proc
+        for line in open(path):
+            if line.startswith("/rat/proc ") and (self._processors is None) \
+                    and (processors_start is None):
+                processors_start = len(literal)
+                literal.append(line)
+            elif (line.find("/rat/proclast outroot") >= 0):
+                if (processors_start is not None):
+                    self._segments += ["".join(literal[:processors_start]),
+                                       ("processors",)]
+                    self._processors = "".join(literal[processors_start:])
+                    literal = []
+                    processors_start = None
+                literal.append(line)
+                self._segments += ["".join(literal), ("output",)]
+                literal = []
+            elif (line.find("/rat/inzdab/read_default") >= 0):
+                self._zdab_command = line.split("_")[0]
+                self._segments += ["".join(literal), ("source",)]
+                literal = []
+                processors_start = None # the processors are not contiguous
+            else:
+                literal.append(line)
+        self._segments.append("".join(literal))
+    def _read_command(self, zdab_path, root_path):
+        """ Returns the macro line reading either zdab_path or root_path """
+        if (zdab_path != None):
+            return self._zdab_command+" "+zdab_path+"\n"
+        elif (root_path != None):
+            return "/rat/inroot/read "+root_path+"\n"
+        raise ValueError("MacroTemplate.render: no valid zdab or root file")
+    def _output_command(self, output_path):
+        """ Returns the macro line setting the output Root file """
+        return "/rat/procset file \""+str(output_path)+"\"\n"
+    def render(self, zdab_path=None, root_path=None, output_path=None):
+        """ Returns the text of the macro reading either zdab_path or
+        root_path and writing processed events to output_path
+        """
+        return self.render_batch([(zdab_path, root_path, output_path)])
+    def render_batch(self, inputs):
+        """ Returns the text of a macro processing several inputs in one RAT
+        invocation. inputs is a list of (zdab_path, root_path, output_path)
+        tuples, as for render. Before each input after the first, the output
+        processor is re-pointed at that input's output file with a further
+        /rat/procset file command.
+        """
+        source = []
+        for index, (zdab_path, root_path, output_path) in enumerate(inputs):
+            if (index > 0):
+                source.append(self._output_command(output_path))
+            source.append(self._read_command(zdab_path, root_path))
+        return self._fill({"source": "".join(source),
+                           "output": self._output_command(inputs[0][2]),
+                           "processors": self._processors})
+    def render_chain(self, zdab_path, output_paths):
+        """ Returns the text of a macro running several passes over
+        zdab_path in one RAT invocation, by repeating the template's
+        processors once per pass. output_paths lists the output Root file
+        of each pass in order; the last is always written, earlier passes
+        only write theirs if it is not None.
+        """
+        if not self._processors:
+            raise ValueError("MacroTemplate.render_chain: no /rat/proc lines "
+                             "before /rat/proclast outroot to chain in "
+                             +self._path)
+        processors = []
+        for output_path in output_paths[:-1]:
+            processors.append(self._processors)
+            if (output_path != None):
+                processors.append("/rat/proc outroot\n"
+                                  +self._output_command(output_path))
+        processors.append(self._processors)
+        return self._fill({"source": self._read_command(zdab_path, None),
+                           "output": self._output_command(output_paths[-1]),
+                           "processors": "".join(processors)})
+    def _fill(self, slots):
+        """ Returns the template text with slots filled from the dict slots """
+        text = []
+        for segment in self._segments:
+            if isinstance(segment, tuple):
+                text.append(slots[segment[0]])
+            else:
+                text.append(segment)
+        return "".join(text)
+
+def get_template(path):
+    """ Returns the compiled template for path. Templates are compiled once
+    per process and only recompiled if the template file is modified.
+    """
+    mtime = os.stat(path).st_mtime
+    cached = _templates.get(path)
+    if (cached is None) or (cached[0] != mtime):
+        cached = (mtime, MacroTemplate(path))
+        _templates[path] = cached
+    return cached[1]
+
+def write_macros(macros):
+    """ Writes a batch of rendered macros, given as (path, text) pairs """
+    for path, text in macros:
+        with open(path, "w") as macro_file:
+            macro_file.write(text)
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+#
+# rat_supervisor.py
+#
+# Runs a RAT process, streaming its stdout/stderr into rotating log files
+# and killing it if it exceeds wall-clock, memory or output-stall limits
+#
+###############################################################################
+import logging
+import logging.handlers
+import os
+import re
+import signal
+import subprocess
+import threading
+import time
+
+# Matches RAT output lines reporting the number of events processed so far
+DEFAULT_PROGRESS_PATTERN = r"[Ee]vents?\s*(?:processed)?\s*[:=#]?\s*([0-9]+)"
+
+def get_rss(pid):
+    """ Returns the resident set size, in bytes, of process pid read from
+    /proc, or None if it cannot be determined
+    """
+    try:
+        with open("/proc/"+str(pid)+"/status", "r") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])*1024
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    return None
+
+def _start_session():
+    """ Runs in the child before RAT is executed: starts a new session, so
+    that RAT can be killed with its children, and restores the default
+    handling of the signals that pool workers ignore
+    """
+    os.setsid()
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+class RATSupervisor(object):
+    """ Supervises a single RAT invocation.
+
+    Each of stdout and stderr is read line by line in its own thread and
+    written to a rotating log file, <log_base>.stdout.log and
+    <log_base>.stderr.log. The main thread polls the process, parsing the
+    number of events processed from its output, and kills it if a limit is
+    exceeded. Limits of None are not enforced.
+    """
+    def __init__(self, log_base, wall_time=None, max_memory=None,
+                 stall_time=None, max_log_bytes=50*1024*1024, log_backups=3,
+                 poll_interval=0.25, report_interval=60.0,
+                 progress_pattern=DEFAULT_PROGRESS_PATTERN):
+        """ Sets the log location and limits. wall_time and stall_time (the
+        longest time allowed without any output) are in seconds, max_memory
+        is in bytes.
+        """
+        self._log_base = log_base
+        self._wall_time = wall_time
+        self._max_memory = max_memory
+        self._stall_time = stall_time
+        self._max_log_bytes = max_log_bytes
+        self._log_backups = log_backups
+        self._poll_interval = poll_interval
+        self._report_interval = report_interval
+        self._progress = re.compile(progress_pattern)
+        self.events = 0 # events processed, parsed from RAT output
+        self.peak_rss = None
+        self.kill_reason = None
+        self._last_output = None
+    def get_log_paths(self):
+        """ Returns the paths of the stdout and stderr log files """
+        return (self._log_base+".stdout.log", self._log_base+".stderr.log")
+    def _make_handler(self, path):
+        """ Returns a rotating log handler that writes bare lines to path """
+        handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=self._max_log_bytes, backupCount=self._log_backups)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        return handler
+    def _stream(self, stream, handler):
+        """ Copies lines from stream to handler until the stream closes """
+        for line in iter(stream.readline, ""):
+            self._last_output = time.time()
+            line = line.rstrip("\n")
+            match = self._progress.search(line)
+            if match:
+                self.events = max(self.events, int(match.group(1)))
+            handler.handle(logging.makeLogRecord({"msg": line}))
+        stream.close()
+    def _check_limits(self, process, start):
+        """ Returns the reason to kill process, or None if within limits """
+        now = time.time()
+        if (self._wall_time is not None) and (now-start > self._wall_time):
+            return "wall time limit of "+str(self._wall_time)+" s exceeded"
+        if (self._stall_time is not None) and \
+                (now-self._last_output > self._stall_time):
+            return "no output for "+str(self._stall_time)+" s"
+        rss = get_rss(process.pid)
+        if rss is not None:
+            if (self.peak_rss is None) or (rss > self.peak_rss):
+                self.peak_rss = rss
+            if (self._max_memory is not None) and (rss > self._max_memory):
+                return "memory limit of "+str(self._max_memory)+\
+                    " bytes exceeded ("+str(rss)+" bytes)"
+        return None
+    def _kill(self, process, grace=10.0):
+        """ Terminates the process group of process, escalating to SIGKILL
+        after grace seconds
+        """
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+            deadline = time.time()+grace
+            while (process.poll() is None) and (time.time() < deadline):
+                time.sleep(0.1)
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError: # process group already exited
+            pass
+    def run(self, command, cwd=None):
+        """ Runs command (a list of arguments) and supervises it until it
+        exits. The command is run in its own session so that it can be
+        killed along with any children. Returns its exit code, negative if it
+        was killed by a signal.
+        """
+        stdout_path, stderr_path = self.get_log_paths()
+        handlers = [self._make_handler(stdout_path),
+                    self._make_handler(stderr_path)]
+        start = time.time()
+        self._last_output = start
+        last_report = start
+        process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, cwd=cwd,
+                                   close_fds=True,
+                                   preexec_fn=_start_session)
+        threads = [threading.Thread(target=self._stream,
+                                    args=(stream, handler))
+                   for stream, handler in zip([process.stdout, process.stderr],
+                                              handlers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            while process.poll() is None:
+                self.kill_reason = self._check_limits(process, start)
+                if self.kill_reason is not None:
+                    print "RATSupervisor.run: killing", command[-1], "-",
+                    print self.kill_reason
+                    self._kill(process)
+                    break
+                now = time.time()
+                if (now-last_report >= self._report_interval):
+                    print "RATSupervisor.run:", command[-1], "running for",
+                    print int(now-start), "s,", self.events, "events processed"
+                    last_report = now
+                # returns as soon as stdout closes, usually when RAT exits;
+                # if RAT closed it and kept running, sleep between checks
+                if threads[0].is_alive():
+                    threads[0].join(self._poll_interval)
+                else:
+                    time.sleep(self._poll_interval)
+        except KeyboardInterrupt:
+            self.kill_reason = "interrupted"
+            self._kill(process)
+            raise
+        finally:
+            for thread in threads:
+                thread.join()
+            for handler in handlers:
+                handler.close()
+        return process.wait()
@@ -12,13 +12,61 @@
 ###############################################################################
 import file_manips
 import list_manips
+import dq_discovery
+import dq_manifest
+import dq_metrics
+import dq_prescan
+import dq_queue
+import dq_records
+import dq_staging
+import dq_watch
+import macro_template
+import rat_supervisor
 
+import multiprocessing
+import signal
 import subprocess
 import sys
+import threading
+import time
 import os
 import re
 import socket
 import shutil
+import tempfile
+
+_run_pattern = re.compile(r"SNOP_([0-9]+)_([0-9]+)")
+# Outputs of a RAT run collected by RunDQ.clean_up
+_record_pattern = re.compile(r"^DATAQUALITY_RECORDS_[0-9]+\..*")
+_plot_pattern = re.compile(r".*\.png$")
+_log_pattern = re.compile(r"^rat\."+re.escape(socket.gethostname())
+                          +r"\.[0-9]+\.log$"
+                          r"|^rat\..+\.std(out|err)\.log(\.[0-9]+)?$")
+
+def get_template_path(read_macro_path="default"):
+    """ Returns the path to the template macro, by default the standard
+    processing macro in $RATROOT
+    """
+    if (read_macro_path == "default"):
+        read_macro_path = os.environ.get("RATROOT") \
+            + "/mac/processing/processing.mac"
+    return read_macro_path
+
+def get_macro_hash(read_macro_path="default"):
+    """ Returns the content hash of the template macro, recorded in the
+    manifests to tell which macro a file was processed with
+    """
+    try:
+        assert (read_macro_path != "default") or os.environ.get("RATROOT"), \
+            "RATROOT not set"
+        return dq_manifest.hash_file(get_template_path(read_macro_path))
+    except AssertionError as detail:
+        print "run_dq.py: error", detail
+        print " --> source correct environment scripts before running!"
+        sys.exit(1)
+    except IOError as detail:
+        print "run_dq.py: error cannot read template macro,", detail
+        sys.exit(1)
 
 class RunDQ(object):
     """ Base class for DQ processing """
@@ -47,14 +95,32 @@ class RunDQ(object):
                 error_message += (". Please supply a valid processed Root file"
                                   " or raw zdab")
                 assert (pass_index != None), error_message
-                self._name = ""
-                for index in range(0, pass_index):
-                    self._name += name_attributes[index] + "_"
+                # name without the pass count, as for a zdab, so that the
+                # outputs of every pass are named alike; names written with
+                # a doubled "_" before the pass count have an empty item
+                self._name = "_".join(attribute for attribute
+                                      in name_attributes[:pass_index]
+                                      if attribute)
             except AssertionError as detail:
                 print "RunDQ.__init__: error", detail
                 sys.exit(1)
             self._root_path = self._path
         self._write_macro_path = None
+        self._write_macro_dir = None
+        self._kill_reason = None
+        self._rat_stats = {}
+    def get_output_path(self):
+        """ Returns the path of the RAT Root file written by this pass """
+        return self._dir+self._name+"_p"+str(self._pass_number)+".root"
+    def get_run_subrun(self):
+        """ Returns the (run, subrun) numbers from the filename, or None """
+        match = _run_pattern.search(self._name)
+        if not match:
+            return None
+        return int(match.group(1)), int(match.group(2))
+    def get_path(self):
+        """ Returns the path of the input file """
+        return self._path
     def convert_zdab(self, root_dir=""):
         """ DEPRECIATED METHOD - use inzdab in macro
         Uses the zdab2root converter in rat-tools to convert zdab file to 
@@ -79,51 +145,90 @@ class RunDQ(object):
         command = "/"+RATZDAB_DIR+"zdab2root "+self._path+" "+self._root_path
         process = subprocess.Popen(command.split(), stdout=subprocess.PIPE)
         output = process.communicate()[0]
+    def get_macro_input(self):
+        """ Returns the (zdab_path, root_path, output_path) tuple describing
+        this file to a MacroTemplate
+        """
+        try:
+            assert ((self._zdab_path != None) or \
+                        (self._root_path != None)), \
+                        "No valid zdab or root file"
+        except AssertionError as detail:
+            print "RunDQ.get_macro_input: ERROR", detail
+            sys.exit(1)
+        return self._zdab_path, self._root_path, self.get_output_path()
+    def get_chain_outputs(self, keep_intermediate=False):
+        """ Returns the output paths of passes 1 to the current pass when
+        they are chained in a single RAT invocation, see render_macro. The
+        paths of earlier passes are None unless keep_intermediate is True.
+        """
+        outputs = []
+        for pass_number in range(1, self._pass_number):
+            if keep_intermediate:
+                outputs.append(self._dir+self._name+"_p"+str(pass_number)
+                               +".root")
+            else:
+                outputs.append(None)
+        return outputs+[self.get_output_path()]
+    def render_macro(self, read_macro_path="default", chain=False,
+                     keep_intermediate=False):
+        """ Returns the text of the macro for this file, rendered from the
+        compiled standard macro template. If chain is True, the raw zdab is
+        taken through every pass up to the current one in a single RAT
+        invocation, without reading back intermediate Root files; these are
+        only written if keep_intermediate is True. Each pass writes the same
+        DQ records files, so only those of the last pass are kept.
+        """
+        template = macro_template.get_template(
+            get_template_path(read_macro_path))
+        if chain:
+            try:
+                assert (self._zdab_path != None), \
+                    "passes can only be chained from a raw zdab file"
+            except AssertionError as detail:
+                print "RunDQ.render_macro: error", detail
+                sys.exit(1)
+            return template.render_chain(
+                self._zdab_path, self.get_chain_outputs(keep_intermediate))
+        return template.render(*self.get_macro_input())
     def write_macro(self, write_macro_dir="default",
-                    read_macro_path="default"):
-        """ Writes macro based on standard macro template """
-        # Open file for writing macro to
+                    read_macro_path="default", echo="default", chain=False,
+                    keep_intermediate=False):
+        """ Writes macro based on standard macro template. The macro is
+        printed if echo is True (the default). For chain and
+        keep_intermediate see render_macro.
+        """
         if (write_macro_dir == "default"):
             write_macro_dir = os.getcwd()
+        if (echo == "default"):
+            echo = True
         self._write_macro_dir = write_macro_dir+"/"
         self._write_macro_path = self._write_macro_dir+self._name+".mac"
-        write_macro = open(self._write_macro_path, "w")
-        # Read from template macro
-        if (read_macro_path == "default"):
-            read_macro_path = os.environ.get("RATROOT") \
-                + "/mac/processing/processing.mac"
-        for line in open(read_macro_path):
-            if (line.find("/rat/proclast outroot") >= 0):
-                write_macro.write(line)
-                write_macro.write("/rat/procset file \""+self._dir+self._name\
-                                      +"_p"+str(self._pass_number)+".root\"\n")
-            elif (line.find("/rat/inzdab/read_default") >= 0):
-                if (self._zdab_path != None):
-                    write_macro.write(line.split("_")[0]+" "+self._zdab_path+"\n")
-                elif (self._root_path != None):
-                    write_macro.write("/rat/inroot/read "+self._root_path+"\n")
-                else:
-                    try:
-                        assert ((self._zdab_path != None) or \
-                                    (self._root_path != None)), \
-                                    "No valid zdab or root file"
-                    except AssertionError as detail:
-                        print "RunDQ.write_macro: ERROR", detail
-                        sys.exit(1)
-            else:
-                write_macro.write(line)
-        write_macro.close()
-        for line in open(self._write_macro_path, "r"):
-            print line.rstrip()
-    def run_rat(self):
-        """ Runs rat using the macro created in write_macro """
+        text = self.render_macro(read_macro_path, chain, keep_intermediate)
+        macro_template.write_macros([(self._write_macro_path, text)])
+        if echo:
+            print text.rstrip()
+    def run_rat(self, wall_time=None, max_memory=None, stall_time=None):
+        """ Runs rat using the macro created in write_macro, from the
+        directory the macro was written to, so that RAT's outputs land there.
+        RAT's output is streamed to rat.<name>.stdout.log and .stderr.log
+        next to the macro (clean_up adds the pass count if the name is
+        taken), and the run is killed if it exceeds the wall_time (s),
+        max_memory (bytes) or stall_time (s, without output) limits.
+        Returns RAT's exit code.
+        """
         try:
             assert (self._write_macro_path != None), \
                 "method RunDQ.write_macro must be used before RunDQ.run_rat" 
-            command = "rat "+self._write_macro_path
             os.environ["RATROOT"]
-            process = subprocess.Popen(command.split(), stdout=subprocess.PIPE)
-            output = process.communicate()[0]
+            log_base = self._write_macro_dir+"rat."+self._name
+            return_code, supervisor = \
+                run_rat_macro(self._write_macro_path, log_base, wall_time,
+                              max_memory, stall_time, self._write_macro_dir)
+            self._kill_reason = supervisor.kill_reason
+            self._rat_stats = {"events": supervisor.events,
+                               "peak_rss": supervisor.peak_rss}
+            return return_code
         except AssertionError as detail:
             print "RunDQ.run_rat: error cannot locate macro,", detail
             sys.exit(1)
@@ -131,50 +236,603 @@ class RunDQ(object):
             print "RunDQ.run_rat: error", detail, "not set"
             print " --> source correct environment scripts before running!"
             sys.exit(1)
-    def clean_up(self, overwrite="default", version="default"):
-        """ Move DQ outputs to their appropriate directory """
+    def get_kill_reason(self):
+        """ Returns why the last RAT run was killed, or None """
+        return self._kill_reason
+    def get_rat_stats(self):
+        """ Returns a dict of the events processed and peak RSS (bytes) of
+        the last RAT run
+        """
+        return self._rat_stats
+    def clean_up(self, overwrite="default", version="default",
+                 work_dir="default", subruns="default"):
+        """ Move DQ outputs to their appropriate directory. Outputs are
+        collected from work_dir, the directory RAT was run from, by default
+        the directory write_macro wrote to. Only the top level of work_dir is
+        listed, so it should be a scratch directory for this run. If
+        $RECORDS_STORE is set, records files are added to the dq_records
+        store there instead of being moved to $RECORDS, attributed to the
+        subrun given for their run in the dict subruns (by default, this
+        file's subrun). Returns the list of paths the outputs were moved to,
+        other than records added to the store.
+        """
         if (overwrite == "default" ):
             overwrite = False # by default
         if (version == "default" ):
             version = 2 # by default
+        if (work_dir == "default"):
+            work_dir = self._write_macro_dir or os.getcwd()
         try:
-            records_dir = os.environ["RECORDS"]
-            plots_dir = os.environ["PLOTS"]
-            logs_dir = os.environ["LOGS"]
+            # RECORDS, PLOTS and LOGS may all be the same directory
+            destinations = {"records": os.environ["RECORDS"],
+                            "plots": os.environ["PLOTS"],
+                            "logs": os.environ["LOGS"]}
         except KeyError as detail:
             print "RunDQ.clean_up: error", detail, "not set"
             print " --> source analysis environment scripts before running!"
             sys.exit(1)
-        for root, dirs, files in os.walk(os.getcwd()):
-            for file in files:
-                is_record = re.search(r"^DATAQUALITY_RECORDS_[0-9]+\..*", file)
-                is_plot = re.search(r".*\.png$", file)
-                hostname = socket.gethostname()
-                is_log =  re.search(r"^rat\."+hostname+r"\.[0-9]+\.log$", file)
-                if is_record:
-                    file_manips.copy_file(os.path.join(root, file), 
-                                          records_dir,
-                                          self._pass_number, 
-                                          version, 
-                                          overwrite)
-                elif is_plot:
-                    file_manips.copy_file(os.path.join(root, file),
-                                          plots_dir,
-                                          self._pass_number,
-                                          version, 
-                                          overwrite)
-                elif is_log:
-                    file_manips.copy_file(os.path.join(root, file), 
-                                          logs_dir,
-                                          self._pass_number,
-                                          version, 
-                                          overwrite)
+        outputs = {"records": [], "plots": [], "logs": []}
+        for file in os.listdir(work_dir):
+            if _record_pattern.match(file):
+                outputs["records"].append(file)
+            elif _plot_pattern.match(file):
+                outputs["plots"].append(file)
+            elif _log_pattern.match(file):
+                outputs["logs"].append(file)
+        moved = []
+        if os.environ.get("RECORDS_STORE"):
+            if (subruns == "default"):
+                subruns = dict([self.get_run_subrun() or (None, None)])
+            store = dq_records.RecordStore(os.environ["RECORDS_STORE"])
+            try:
+                for file in outputs.pop("records"):
+                    run = dq_records.parse_name(file)[0]
+                    name = store.ingest_file(os.path.join(work_dir, file),
+                                             subruns.get(run),
+                                             self._pass_number, remove=True)
+                    print "storing", name, "in", os.environ["RECORDS_STORE"]
+            finally:
+                store.close()
+        for kind in ["records", "plots", "logs"]:
+            for file in outputs.get(kind, []):
+                # name the target, so that a missing directory is an error
+                # rather than the name the file is moved to
+                target = file_manips.copy_file(
+                    os.path.join(work_dir, file),
+                    os.path.join(destinations[kind], file),
+                    self._pass_number, version, overwrite)
+                if target is not None:
+                    moved.append(target)
+        return moved
+
+def run_rat_macro(macro_path, log_base, wall_time=None, max_memory=None,
+                  stall_time=None, cwd=None):
+    """ Runs rat on macro_path from directory cwd under a RATSupervisor, see
+    RunDQ.run_rat. Returns RAT's exit code and the supervisor.
+    """
+    supervisor = rat_supervisor.RATSupervisor(log_base, wall_time,
+                                              max_memory, stall_time)
+    return_code = supervisor.run(["rat", macro_path], cwd)
+    print "run_rat_macro:", supervisor.events, "events processed"
+    return return_code, supervisor
+
+class RunDQBatch(object):
+    """ Processes several files with a single RAT invocation, so that RAT's
+    start-up cost is only paid once. DQ records are named by run number
+    only, so all files in a batch must come from different runs; the records
+    can then be attributed to the right subrun.
+    """
+    def __init__(self, paths, pass_number="default"):
+        """ Creates a RunDQ for each of paths """
+        self._members = [RunDQ(path, pass_number) for path in paths]
+        self._write_macro_path = None
+        self._write_macro_dir = None
+        self._kill_reason = None
+        self._rat_stats = {}
+        runs = [member.get_run_subrun() for member in self._members]
+        try:
+            assert (None not in runs), \
+                "Filenames must contain SNOP_<run>_<subrun>"
+            run_numbers = [run for run, subrun in runs]
+            assert (len(set(run_numbers)) == len(run_numbers)), \
+                "Files in a batch must come from different runs"
+        except AssertionError as detail:
+            print "RunDQBatch.__init__: error", detail
+            sys.exit(1)
+    def get_members(self):
+        """ Returns the RunDQ object of each file in the batch """
+        return self._members
+    def write_macro(self, write_macro_dir="default",
+                    read_macro_path="default", echo="default"):
+        """ Writes a single macro reading every file in the batch, each with
+        its own output Root file
+        """
+        if (write_macro_dir == "default"):
+            write_macro_dir = os.getcwd()
+        if (echo == "default"):
+            echo = True
+        self._write_macro_dir = write_macro_dir+"/"
+        self._write_macro_path = self._write_macro_dir \
+            +self._members[0]._name+"_batch.mac"
+        template = macro_template.get_template(
+            get_template_path(read_macro_path))
+        text = template.render_batch([member.get_macro_input()
+                                      for member in self._members])
+        macro_template.write_macros([(self._write_macro_path, text)])
+        if echo:
+            print text.rstrip()
+    def run_rat(self, wall_time=None, max_memory=None, stall_time=None):
+        """ Runs rat once on the batch macro, see RunDQ.run_rat """
+        try:
+            assert (self._write_macro_path != None), \
+                "method RunDQBatch.write_macro must be used before run_rat"
+            os.environ["RATROOT"]
+        except AssertionError as detail:
+            print "RunDQBatch.run_rat: error cannot locate macro,", detail
+            sys.exit(1)
+        except KeyError as detail:
+            print "RunDQBatch.run_rat: error", detail, "not set"
+            print " --> source correct environment scripts before running!"
+            sys.exit(1)
+        log_base = self._write_macro_dir+"rat."+self._members[0]._name\
+            +"_batch"
+        return_code, supervisor = \
+            run_rat_macro(self._write_macro_path, log_base, wall_time,
+                          max_memory, stall_time, self._write_macro_dir)
+        self._kill_reason = supervisor.kill_reason
+        self._rat_stats = {"events": supervisor.events,
+                           "peak_rss": supervisor.peak_rss}
+        return return_code
+    def get_kill_reason(self):
+        """ Returns why the last RAT run was killed, or None """
+        return self._kill_reason
+    def get_rat_stats(self):
+        """ See RunDQ.get_rat_stats """
+        return self._rat_stats
+    def get_member_status(self, work_dir="default"):
+        """ Checks, before clean_up, which files in the batch were processed.
+        A file is complete if its output Root file exists and work_dir holds
+        the DQ records for its run. Returns a list of (RunDQ, success flag,
+        message) tuples.
+        """
+        if (work_dir == "default"):
+            work_dir = os.getcwd()
+        record_runs = set()
+        for file in os.listdir(work_dir):
+            match = re.search(r"^DATAQUALITY_RECORDS_([0-9]+)\.", file)
+            if match:
+                record_runs.add(int(match.group(1)))
+        status = []
+        for member in self._members:
+            run, subrun = member.get_run_subrun()
+            if not os.path.exists(member.get_output_path()):
+                status.append((member, False, "no output Root file"))
+            elif run not in record_runs:
+                status.append((member, False, "no DQ records for run "
+                               +str(run)))
+            else:
+                status.append((member, True, "ok"))
+        return status
+    def clean_up(self, overwrite="default", version="default",
+                 work_dir="default"):
+        """ Moves the DQ outputs of the whole batch, see RunDQ.clean_up """
+        if (work_dir == "default"):
+            work_dir = self._write_macro_dir or os.getcwd()
+        subruns = dict(member.get_run_subrun() for member in self._members)
+        return self._members[0].clean_up(overwrite, version, work_dir,
+                                         subruns)
+
+def make_batches(file_list, batch_size):
+    """ Splits file_list into batches of at most batch_size files, with no
+    two files in a batch from the same run. Files whose names do not contain
+    a run number are put in batches of their own.
+    """
+    by_run = {}
+    batches = []
+    for path in file_list:
+        match = _run_pattern.search(os.path.basename(path))
+        if match:
+            by_run.setdefault(int(match.group(1)), []).append(path)
+        else:
+            batches.append([path])
+    queues = [sorted(paths, reverse=True)
+              for run, paths in sorted(by_run.items())]
+    while queues:
+        # take one file from each of the runs with most files left
+        queues.sort(key=len, reverse=True)
+        batches.append([queue.pop() for queue in queues[:batch_size]])
+        queues = [queue for queue in queues if queue]
+    return batches
+
+def process_batch(paths, pass_number, overwrite, version, temp_dir,
+                  wall_time=None, max_memory=None, stall_time=None,
+                  echo_macro=False, metrics_path=None):
+    """ As process_file, but processes all of paths with a single RAT
+    invocation using RunDQBatch. Returns a list of process_file style
+    result tuples, one per path.
+    """
+    work_dir = tempfile.mkdtemp(prefix="dq_worker_", dir=temp_dir)
+    metrics = dq_metrics.NoMetrics()
+    results = []
+    try:
+        if metrics_path:
+            metrics = dq_metrics.StageMetrics(paths, pass_number)
+        with metrics.stage("init"):
+            batch = RunDQBatch(paths, pass_number)
+        with metrics.stage("write_macro"):
+            batch.write_macro(work_dir, echo=echo_macro)
+        with metrics.stage("run_rat"):
+            return_code = batch.run_rat(wall_time, max_memory, stall_time)
+        for key, value in batch.get_rat_stats().items():
+            metrics.set("run_rat", key, value)
+        status = batch.get_member_status(work_dir)
+        with metrics.stage("clean_up"):
+            moved = batch.clean_up(overwrite, version, work_dir)
+        metrics.add_outputs(moved+[member.get_output_path()
+                                   for member in batch.get_members()])
+        if (batch.get_kill_reason() != None):
+            message = "rat killed, "+batch.get_kill_reason()
+            results = [(path, False, message, []) for path in paths]
+        elif (return_code != 0):
+            message = "rat exited with code "+str(return_code)
+            results = [(path, False, message, []) for path in paths]
+        else:
+            for member, success, message in status:
+                outputs = []
+                if success:
+                    outputs = [member.get_output_path()]
+                results.append((member.get_path(), success, message, outputs))
+    except SystemExit as detail:
+        message = "aborted with exit status "+str(detail)
+        results = [(path, False, message, []) for path in paths]
+    except Exception as detail:
+        message = type(detail).__name__+": "+str(detail)
+        results = [(path, False, message, []) for path in paths]
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        if metrics_path:
+            metrics.write(metrics_path,
+                          all(result[1] for result in results))
+    return results
+
+def process_file(path, pass_number, overwrite, version, temp_dir,
+                 wall_time=None, max_memory=None, stall_time=None,
+                 echo_macro=False, metrics_path=None, chain=False,
+                 keep_intermediate=False):
+    """ Runs the full DQ processing chain on a single file. RAT is run from a
+    private scratch directory inside temp_dir, so that clean_up only lists
+    the outputs of this file, even when several files are processed at once.
+    The limits are passed on to RunDQ.run_rat. The generated macro is only
+    printed if echo_macro is True. If metrics_path is given, the time and
+    resources used by each stage are appended to it, see dq_metrics. If
+    chain is True, passes 1 to pass_number are run on the raw zdab path in
+    one RAT invocation, see RunDQ.render_macro. Returns a tuple of the path,
+    a success flag, a status message and the list of outputs written
+    alongside the input.
+    """
+    work_dir = tempfile.mkdtemp(prefix="dq_worker_", dir=temp_dir)
+    metrics = dq_metrics.NoMetrics()
+    result = (path, False, "not processed", [])
+    try:
+        if metrics_path:
+            metrics = dq_metrics.StageMetrics([path], pass_number)
+        with metrics.stage("init"):
+            data_quality = RunDQ(path, pass_number)
+        with metrics.stage("write_macro"):
+            data_quality.write_macro(work_dir, echo=echo_macro, chain=chain,
+                                     keep_intermediate=keep_intermediate)
+        with metrics.stage("run_rat"):
+            return_code = data_quality.run_rat(wall_time, max_memory,
+                                               stall_time)
+        for key, value in data_quality.get_rat_stats().items():
+            metrics.set("run_rat", key, value)
+        with metrics.stage("clean_up"):
+            moved = data_quality.clean_up(overwrite, version, work_dir)
+        metrics.add_outputs(moved+[data_quality.get_output_path()])
+        if (data_quality.get_kill_reason() != None):
+            result = (path, False,
+                      "rat killed, "+data_quality.get_kill_reason(), [])
+        elif (return_code != 0):
+            result = (path, False, "rat exited with code "+str(return_code),
+                      [])
+        elif chain:
+            result = (path, True, "ok",
+                      [output for output in
+                       data_quality.get_chain_outputs(keep_intermediate)
+                       if output != None])
+        else:
+            result = (path, True, "ok", [data_quality.get_output_path()])
+    except SystemExit as detail:
+        result = (path, False, "aborted with exit status "+str(detail), [])
+    except Exception as detail:
+        result = (path, False, type(detail).__name__+": "+str(detail), [])
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        if metrics_path:
+            metrics.write(metrics_path, result[1])
+    return result
+
+def process_staged(paths, scratch_dir, max_scratch_bytes, prefetch,
+                   pass_number, overwrite, version, temp_dir, wall_time=None,
+                   max_memory=None, stall_time=None, echo_macro=False,
+                   metrics_path=None):
+    """ Processes paths in turn with process_file, from copies staged in
+    scratch_dir (node-local storage) by a dq_staging.Stager while the
+    previous files are processed. RAT writes its output root file beside the
+    staged copy; it is moved back beside the original input in the
+    background by a dq_staging.Flusher. Returns the list of process_file
+    results, in terms of the original paths, once all outputs have been
+    moved back.
+    """
+    stager = dq_staging.Stager(paths, scratch_dir, max_scratch_bytes,
+                               prefetch)
+    flusher = dq_staging.Flusher()
+    stager.start()
+    flusher.start()
+    results = []
+    try:
+        for path in paths:
+            local_path = stager.acquire(path)
+            result = process_file(local_path, pass_number, overwrite, version,
+                                  temp_dir, wall_time, max_memory,
+                                  stall_time, echo_macro, metrics_path)
+            outputs = []
+            if result[1] and (local_path != path):
+                moves = [(output, os.path.join(os.path.dirname(path),
+                                               os.path.basename(output)))
+                         for output in result[3]]
+                outputs = [destination for output, destination in moves]
+                flusher.flush(path, moves, stager.release)
+            else:
+                outputs = result[3]
+                stager.release(path)
+            results.append((path, result[1], result[2], outputs))
+    finally:
+        flusher.finish()
+        stager.stop()
+    for index, result in enumerate(results):
+        if result[0] in flusher.errors:
+            results[index] = (result[0], False, flusher.errors[result[0]], [])
+    return results
+
+def _process_staged_args(args):
+    """ Unpacks an argument tuple for process_staged, for use with Pool.map """
+    return process_staged(*args)
+
+def _process_file_args(args):
+    """ Unpacks an argument tuple for process_file, for use with Pool.map """
+    return process_file(*args)
+
+def _process_batch_args(args):
+    """ Unpacks an argument tuple for process_batch, for use with Pool.map """
+    return process_batch(*args)
+
+def drain_queue(queue_path, lease_time, max_attempts, overwrite, version,
+                temp_dir, wall_time=None, max_memory=None, stall_time=None,
+                echo_macro=False, metrics_path=None, macro_hash=None,
+                use_hash=False):
+    """ Claims files from the work queue at queue_path and processes them
+    with process_file until there are none left. The lease on each file is
+    renewed while it is processed; completed files are recorded in the queue
+    and in the manifest of their directory. Returns the list of process_file
+    results for the files this worker processed.
+    """
+    queue = dq_queue.WorkQueue(queue_path)
+    worker = dq_queue.get_worker_id()
+    results = []
+    try:
+        while True:
+            item = queue.claim(worker, lease_time, max_attempts)
+            if item is None:
+                break
+            path, pass_number = item
+            print worker, "claimed", path
+            keeper = dq_queue.LeaseKeeper(queue_path, path, pass_number,
+                                          worker, lease_time)
+            keeper.start()
+            try:
+                result = process_file(path, pass_number, overwrite, version,
+                                      temp_dir, wall_time, max_memory,
+                                      stall_time, echo_macro, metrics_path)
+            finally:
+                keeper.stop()
+            if result[1]:
+                dq_manifest.record_completed(path, pass_number, macro_hash,
+                                             result[3], use_hash)
+            if not queue.complete(path, pass_number, worker, result[1],
+                                  result[2], result[3]):
+                print "drain_queue: warning, lease on", path, "was lost,",
+                print "result not recorded"
+            results.append(result)
+    finally:
+        queue.close()
+    return results
+
+def _drain_queue_args(args):
+    """ Unpacks an argument tuple for drain_queue, for use with Pool.map """
+    return drain_queue(*args)
+
+def process_and_record(path, pass_number, overwrite, version, temp_dir,
+                       wall_time=None, max_memory=None, stall_time=None,
+                       echo_macro=False, metrics_path=None, macro_hash=None,
+                       use_hash=False):
+    """ As process_file, then records the file in the manifest of its
+    directory if it succeeded
+    """
+    result = process_file(path, pass_number, overwrite, version, temp_dir,
+                          wall_time, max_memory, stall_time, echo_macro,
+                          metrics_path)
+    if result[1]:
+        dq_manifest.record_completed(path, pass_number, macro_hash, result[3],
+                                     use_hash)
+    return result
+
+def _process_and_record_args(args):
+    """ Unpacks an argument tuple for process_and_record, for use with
+    Pool.apply_async
+    """
+    return process_and_record(*args)
+
+def _ignore_interrupts():
+    """ Pool initializer: workers ignore SIGINT and SIGTERM, which may be
+    sent to the whole process group, and leave them to the parent, which
+    lets running files finish. The parent interrupts the workers with
+    SIGUSR1 to abandon them, see _abandon_workers.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR1, signal.default_int_handler)
+
+def _abandon_workers(pool):
+    """ Interrupts the pool's workers, which kill their RAT runs, then
+    terminates the pool
+    """
+    for child in multiprocessing.active_children():
+        try:
+            os.kill(child.pid, signal.SIGUSR1)
+        except OSError: # already exited
+            pass
+    pool.terminate()
+
+def map_tasks(function, tasks, jobs):
+    """ Returns the results of function applied to each of tasks, in order,
+    by a pool of jobs workers. On SIGINT or SIGTERM the running tasks are
+    abandoned, see _abandon_workers, and the process exits.
+    """
+    def interrupt(signal_number, frame):
+        raise KeyboardInterrupt
+    previous = signal.signal(signal.SIGTERM, interrupt)
+    pool = multiprocessing.Pool(jobs, _ignore_interrupts)
+    try:
+        result = pool.map_async(function, tasks, chunksize=1)
+        # wait in steps, as a wait without a timeout blocks signals
+        while not result.ready():
+            result.wait(1.)
+        pool.close()
+        return result.get()
+    except KeyboardInterrupt:
+        print "run_dq.py: interrupted, abandoning running files"
+        _abandon_workers(pool)
+        sys.exit(1)
+    finally:
+        pool.join()
+        signal.signal(signal.SIGTERM, previous)
+
+def watch_directory(watcher, jobs, pass_number, overwrite, version, temp_dir,
+                    wall_time=None, max_memory=None, stall_time=None,
+                    echo_macro=False, metrics_path=None, macro_hash=None,
+                    use_hash=False):
+    """ Processes files as watcher reports them complete, until interrupted
+    (SIGINT or SIGTERM). At most jobs files are processed at once and at
+    most jobs more, oldest first, wait in a backlog; further files are left
+    for later polls of the watcher, which is polled at its own interval or
+    when a running file finishes. Files already recorded as complete in
+    their directory's manifest are skipped, so a restarted watch resumes
+    where it stopped. Each file's records and plots are published, and it
+    is recorded in the manifest, as soon as it is done. On the first signal
+    the running files are finished, on a second they are abandoned.
+    Returns the list of process_file results.
+    """
+    stopping = []
+    def stop(signal_number, frame):
+        stopping.append(signal_number)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    manifests = {}
+    def is_complete(path):
+        directory = os.path.dirname(path)
+        if directory not in manifests:
+            manifests[directory] = dq_manifest.DQManifest(directory)
+        if manifests[directory].is_complete(path, pass_number, macro_hash,
+                                            use_hash):
+            print "watch_directory: skipping completed file", path
+            return True
+        return False
+    finished = threading.Event() # set as each running file finishes
+    backlog = []
+    running = []
+    results = []
+    def collect():
+        """ Moves the results of finished files to results, returning how
+        many there were
+        """
+        done = [task for task in running if task[1].ready()]
+        for path, task in done:
+            running.remove((path, task))
+            try:
+                result = task.get()
+            except Exception as detail:
+                result = (path, False, type(detail).__name__+": "
+                          +str(detail), [])
+            if result[1]:
+                print "watch_directory: OK", result[0]
+            else:
+                print "watch_directory: FAILED", result[0], "-->",
+                print result[2]
+            results.append(result)
+        return len(done)
+    pool = multiprocessing.Pool(jobs, _ignore_interrupts)
+    joined = False
+    try:
+        poll_due = True
+        last_poll = time.time()
+        while not stopping:
+            finished.clear()
+            if collect() and not backlog:
+                poll_due = True # a job is free, look for its next file
+            if poll_due and (len(backlog) < jobs):
+                backlog += watcher.poll(jobs-len(backlog), is_complete)
+                last_poll = time.time()
+                poll_due = False
+            while backlog and (len(running) < jobs):
+                path = backlog.pop(0)
+                print "watch_directory: processing", path
+                task = (path, pass_number, overwrite, version, temp_dir,
+                        wall_time, max_memory, stall_time, echo_macro,
+                        metrics_path, macro_hash, use_hash)
+                running.append((path, pool.apply_async(
+                            _process_and_record_args, (task,),
+                            callback=lambda result: finished.set())))
+            if stopping:
+                break
+            if running:
+                # wake when a running file finishes, to start the next
+                timeout = 1.
+                if (len(backlog) < jobs):
+                    timeout = max(last_poll+watcher.get_interval()
+                                  -time.time(), 0.)
+                finished.wait(timeout)
+                if (time.time() >= last_poll+watcher.get_interval()):
+                    poll_due = True
+            else:
+                watcher.wait()
+                poll_due = True
+        print "watch_directory: stopping, waiting for", len(running),
+        print "running files;", len(backlog), "files left in the backlog"
+        pool.close()
+        if running:
+            print "watch_directory: signal again to abandon them"
+        while running and (len(stopping) < 2):
+            finished.clear()
+            collect()
+            if running:
+                finished.wait(1.)
+        if running:
+            print "watch_directory: abandoning", len(running), "running files"
+            _abandon_workers(pool)
+        pool.join()
+        joined = True
+    finally:
+        if not joined:
+            _abandon_workers(pool)
+            pool.join()
+        watcher.close()
+    return results
 
 ###############################################################################
 if __name__=="__main__":
     import argparse    
     import contextlib
-    import tempfile
 
     parser = argparse.ArgumentParser(description="Run DQ processors")
     parser.add_argument("directory", help="indicate directory containing"
@@ -186,22 +844,114 @@ if __name__=="__main__":
                         "images and record files")
     parser.add_argument("-o", "--overwrite", help="if output record files/"
                         "plots already exist, overwrite", action="store_true")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of files to process in parallel")
+    parser.add_argument("-i", "--incremental", action="store_true",
+                        help="skip files already processed for this pass, "
+                        "according to the manifest in each output directory")
+    parser.add_argument("--hash", action="store_true",
+                        help="with --incremental, also compare input file "
+                        "content hashes rather than just size and mtime")
+    parser.add_argument("--timeout", type=float, help="kill RAT runs that "
+                        "take longer than this many seconds")
+    parser.add_argument("--stall-timeout", type=float, help="kill RAT runs "
+                        "that produce no output for this many seconds")
+    parser.add_argument("--max-memory", type=float, help="kill RAT runs "
+                        "whose resident memory exceeds this many MB")
+    parser.add_argument("--echo-macro", action="store_true",
+                        help="print each generated macro")
+    parser.add_argument("--index", help="file in which to cache directory "
+                        "listings between invocations")
+    parser.add_argument("-m", "--metrics", help="append per-stage timing and "
+                        "resource records (JSON lines) to this file; "
+                        "summarise them with dq_metrics.py")
+    parser.add_argument("-b", "--batch-size", type=int, default=1,
+                        help="process up to this many files (from different "
+                        "runs) in each RAT invocation")
+    parser.add_argument("--queue", help="shared work queue (SQLite) file; "
+                        "files found are added to the queue, then this and "
+                        "any other workers using the queue process them")
+    parser.add_argument("--lease", type=float, default=3600.,
+                        help="seconds a queued file is leased to a worker "
+                        "before others may claim it (renewed while running)")
+    parser.add_argument("--max-attempts", type=int, default=3,
+                        help="number of times a queued file may be claimed")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="return failed files in the queue to pending")
+    parser.add_argument("-w", "--watch", action="store_true",
+                        help="keep watching the directory and process files "
+                        "as they are completed, until interrupted; files "
+                        "already in the manifests are skipped")
+    parser.add_argument("--settle", type=float, default=30.,
+                        help="with --watch, seconds a file must be unmodified "
+                        "to be considered complete")
+    parser.add_argument("--poll", type=float, default=10.,
+                        help="with --watch, seconds between directory scans")
+    parser.add_argument("--marker", default=".done",
+                        help="with --watch, suffix of the marker file that "
+                        "flags a file as complete without waiting for it "
+                        "to settle")
+    parser.add_argument("--stage", help="node-local scratch directory to "
+                        "which inputs are copied ahead of processing, and "
+                        "in which outputs are written before being moved "
+                        "back")
+    parser.add_argument("--stage-limit", type=float, default=20000.,
+                        help="with --stage, most scratch space (MB) staged "
+                        "inputs may take up, per job")
+    parser.add_argument("--prefetch", type=int, default=2,
+                        help="with --stage, number of inputs each job stages "
+                        "ahead of the one it is processing")
+    parser.add_argument("--chain", action="store_true",
+                        help="run passes 1 to --passnum on the raw zdab "
+                        "files in a single RAT invocation per file, rather "
+                        "than reading the previous pass's Root files")
+    parser.add_argument("--keep-intermediate", action="store_true",
+                        help="with --chain, also write the Root files of "
+                        "the passes before --passnum")
+    parser.add_argument("--records-store", help="add DQ records files to "
+                        "the consolidated store in this directory (see "
+                        "dq_records.py) rather than $RECORDS; defaults to "
+                        "$RECORDS_STORE")
+    parser.add_argument("--prescan", choices=["size", "events"],
+                        help="estimate the cost of each file from its size, "
+                        "or from a count of zdab event records (sizes are "
+                        "used if any file is not a zdab), and dispatch the "
+                        "most costly files first")
+    parser.add_argument("--rate", type=float, help="with --prescan, cost "
+                        "processed per second by one job (MB/s, or events/s "
+                        "for --prescan events) used to predict the completion "
+                        "time; by default taken from the --metrics file")
     args = parser.parse_args()
+    try:
+        assert not (args.queue and (args.batch_size > 1 or args.prescan or
+                                    args.watch)), \
+            "--queue cannot be combined with --batch-size, --prescan or " \
+            "--watch"
+        assert not (args.watch and (args.batch_size > 1 or args.prescan)), \
+            "--watch cannot be combined with --batch-size or --prescan"
+        assert not (args.stage and (args.batch_size > 1 or args.queue or
+                                    args.watch)), \
+            "--stage cannot be combined with --batch-size, --queue or --watch"
+        assert not (args.chain and (args.batch_size > 1 or args.queue or
+                                    args.watch or args.stage)), \
+            "--chain cannot be combined with --batch-size, --queue, --watch " \
+            "or --stage"
+    except AssertionError as detail:
+        print "run_dq.py: error", detail
+        sys.exit(1)
+    if args.records_store:
+        # read by RunDQ.clean_up, in this process and in worker processes
+        os.environ["RECORDS_STORE"] = os.path.abspath(args.records_store)
+    metrics_path = None
+    if args.metrics:
+        metrics_path = os.path.abspath(args.metrics)
+    max_memory = None
+    if args.max_memory:
+        max_memory = int(args.max_memory*1024*1024)
 
     # set environment
     env=os.environ.copy()
 
-    # make list of files
-    file_list = []
-    for root, dirs, files in os.walk(args.directory):
-        for file in files:
-            if args.passnum == 1: # zdab
-                match = re.search(r"_[0-9]+.zdab", file)
-            else:
-                match = re.search(r"_p"+str(args.passnum-1)+".root", file)
-            if match:
-                file_list.append(os.path.join(root, file))
-    
     # make temporary directory to write macro files
     @contextlib.contextmanager
     def temporary_directory(*args, **kwargs):
@@ -211,10 +961,177 @@ if __name__=="__main__":
         finally:
             shutil.rmtree(d)
 
-    with temporary_directory() as temp_dir:
+    # the template is only hashed if the manifests are used
+    macro_hashes = []
+    def macro_hash():
+        if not macro_hashes:
+            macro_hashes.append(get_macro_hash())
+        return macro_hashes[0]
+
+    # process files as they arrive, until interrupted
+    if args.watch:
+        if args.passnum == 1:
+            watcher = dq_watch.DirectoryWatcher(args.directory, "zdab", None,
+                                                args.settle, args.poll,
+                                                args.marker, args.index)
+        else:
+            watcher = dq_watch.DirectoryWatcher(args.directory, "root",
+                                                args.passnum-1, args.settle,
+                                                args.poll, args.marker,
+                                                args.index)
+        print "run_dq.py: watching", args.directory,
+        print "(inotify)" if watcher.uses_inotify() else "(polling)"
+        with temporary_directory() as temp_dir:
+            results = watch_directory(watcher, args.jobs, args.passnum,
+                                      args.overwrite, args.version, temp_dir,
+                                      args.timeout, max_memory,
+                                      args.stall_timeout, args.echo_macro,
+                                      metrics_path, macro_hash(), args.hash)
+        failed = [result for result in results if not result[1]]
+        print "run_dq.py: processed", len(results), "files,", len(failed),
+        print "failed"
+        sys.exit(0)
+
+    # make list of files
+    if (args.passnum == 1) or args.chain: # zdab
+        records = dq_discovery.find_files(args.directory, "zdab", None,
+                                          args.index)
+    else:
+        records = dq_discovery.find_files(args.directory, "root",
+                                          args.passnum-1, args.index)
+    file_list = [record.path for record in records]
+
+    # skip files that are unchanged since they were last processed
+    manifests = {}
+    def get_manifest(path):
+        directory = os.path.dirname(path)
+        if directory not in manifests:
+            manifests[directory] = dq_manifest.DQManifest(directory)
+        return manifests[directory]
+    if args.incremental:
+        new_file_list = []
         for file in file_list:
-            print file
-            data_quality = RunDQ(file, args.passnum)
-            data_quality.write_macro(temp_dir)
-            data_quality.run_rat()
-            data_quality.clean_up(args.overwrite, args.version)
+            if get_manifest(file).is_complete(file, args.passnum,
+                                              macro_hash(), args.hash):
+                print "run_dq.py: skipping unchanged file", file
+            else:
+                new_file_list.append(file)
+        file_list = new_file_list
+
+    # estimate the cost of each file and dispatch the most costly first, so
+    # that a few large files processed last do not set the total time
+    costs = None
+    if args.prescan:
+        cost_cache = dq_prescan.CostCache(args.index+".costs"
+                                          if args.index else None)
+        use_events = (args.prescan == "events")
+        estimates = dict((path, cost_cache.estimate(path, use_events))
+                         for path in file_list)
+        cost_cache.save()
+        # costs must all be in one unit, and the rate in the same unit
+        rate = None
+        if use_events and not all(dq_prescan.has_events(estimate)
+                                  for estimate in estimates.values()):
+            print "run_dq.py: warning, not every file has an event count",
+            print "(e.g. root files), using file sizes"
+            use_events = False
+            if args.rate:
+                print "run_dq.py: warning, ignoring --rate in events/s"
+        elif args.rate:
+            rate = args.rate if use_events else args.rate*1e6
+        costs = dict((path, dq_prescan.get_cost(estimate, use_events))
+                     for path, estimate in estimates.items())
+        file_list = dq_prescan.order_largest_first(
+            file_list, [costs[path] for path in file_list])
+        if (rate is None) and metrics_path and os.path.exists(metrics_path):
+            byte_rate, event_rate = dq_prescan.rates_from_metrics(metrics_path)
+            rate = event_rate if use_events else byte_rate
+        if rate and file_list:
+            makespan = dq_prescan.predict_makespan(costs.values(), args.jobs,
+                                                   rate)
+            print "run_dq.py: predicted completion in %.0f s with %d jobs" % \
+                (makespan, args.jobs)
+
+    if args.queue:
+        queue_path = os.path.abspath(args.queue)
+        queue = dq_queue.WorkQueue(queue_path)
+        print "run_dq.py: added", queue.add(file_list, args.passnum),
+        print "files to the queue"
+        if args.retry_failed:
+            print "run_dq.py: retrying", queue.reset_failed(args.passnum),
+            print "failed files"
+        queue.close()
+        with temporary_directory() as temp_dir:
+            drain_args = (queue_path, args.lease, args.max_attempts,
+                          args.overwrite, args.version, temp_dir,
+                          args.timeout, max_memory, args.stall_timeout,
+                          args.echo_macro, metrics_path, macro_hash(),
+                          args.hash)
+            if (args.jobs > 1):
+                results = map_tasks(_drain_queue_args,
+                                    [drain_args]*args.jobs, args.jobs)
+                results = [result for worker in results for result in worker]
+            else:
+                results = drain_queue(*drain_args)
+        queue = dq_queue.WorkQueue(queue_path)
+        print "run_dq.py: this worker processed", len(results), "files;",
+        print "queue status", queue.counts(args.passnum)
+        for path, message in queue.failures(args.passnum):
+            print " FAILED", path, "-->", message
+        queue.close()
+        sys.exit(0)
+
+    with temporary_directory() as temp_dir:
+        if (args.batch_size > 1):
+            work = make_batches(file_list, args.batch_size)
+            if costs is not None:
+                work = dq_prescan.order_largest_first(
+                    work, [sum(costs[path] for path in batch)
+                           for batch in work])
+            process, process_args = process_batch, _process_batch_args
+        elif args.stage:
+            # each job stages and processes its own share of the files, in
+            # dispatch order
+            work = [file_list[job::args.jobs] for job in range(args.jobs)
+                    if file_list[job::args.jobs]]
+            process, process_args = process_staged, _process_staged_args
+        else:
+            work = file_list
+            process, process_args = process_file, _process_file_args
+        tasks = [(item, args.passnum, args.overwrite, args.version, temp_dir,
+                  args.timeout, max_memory, args.stall_timeout,
+                  args.echo_macro, metrics_path)
+                 for item in work]
+        if args.chain:
+            tasks = [task+(True, args.keep_intermediate) for task in tasks]
+        if args.stage:
+            tasks = [(task[0], os.path.abspath(args.stage),
+                      int(args.stage_limit*1024*1024), args.prefetch)
+                     +task[1:] for task in tasks]
+        if (args.jobs > 1):
+            results = map_tasks(process_args, tasks, args.jobs)
+        else:
+            results = []
+            for task in tasks:
+                print task[0]
+                results.append(process(*task))
+        if (args.batch_size > 1) or args.stage:
+            results = [result for batch in results for result in batch]
+
+    # record completed files in the manifests, under the same lock as any
+    # --queue or --watch workers using them
+    for path, success, message, outputs in results:
+        if success:
+            dq_manifest.record_completed(path, args.passnum, macro_hash(),
+                                         outputs, args.hash)
+
+    # summarise outcome of each file
+    failed = [result for result in results if not result[1]]
+    print "run_dq.py: processed", len(results), "files,", len(failed), "failed"
+    for path, success, message, outputs in results:
+        if success:
+            print " OK    ", path
+        else:
+            print " FAILED", path, "-->", message
+    if failed:
+        sys.exit(1)
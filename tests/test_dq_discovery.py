@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+#
+# test_dq_discovery.py
+#
+# Run with: python -m unittest discover tests
+#
+###############################################################################
+import os
+import sys
+import unittest
+
+_dq_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for _path in [_dq_dir, os.path.join(_dq_dir, "utils")]:
+    if _path not in sys.path:
+        sys.path.append(_path)
+
+import dq_discovery
+import run_dq
+
+class TestParseName(unittest.TestCase):
+    def test_outputs_of_run_dq(self):
+        """ Every pass of a subrun is found, whether it was chained from the
+        zdab or read from the Root file of the pass before
+        """
+        chained = run_dq.RunDQ("/data/SNOP_0000100001_002.zdab", 2)
+        from_root = run_dq.RunDQ("/data/SNOP_0000100001_002_p1.root", 2)
+        self.assertEqual(chained.get_output_path(),
+                         from_root.get_output_path())
+        for path in [chained.get_output_path(),
+                     run_dq.RunDQ(from_root.get_output_path(),
+                                  3).get_output_path()]:
+            record = dq_discovery.parse_name(path)
+            self.assertIsNotNone(record, path)
+            self.assertEqual((record.run, record.subrun, record.ext),
+                             (100001, 2, "root"))
+        self.assertEqual(dq_discovery.parse_name(
+                chained.get_output_path()).pass_number, 2)
+    def test_earlier_names(self):
+        """ Outputs named SNOP_<run>_<subrun>__p<n> by earlier versions """
+        record = dq_discovery.parse_name("/data/SNOP_0000100001_002__p2.root")
+        self.assertEqual((record.run, record.subrun, record.pass_number),
+                         (100001, 2, 2))
+        self.assertEqual(run_dq.RunDQ("/data/SNOP_0000100001_002__p2.root",
+                                      3).get_output_path(),
+                         "/data/SNOP_0000100001_002_p3.root")
+    def test_other_names(self):
+        self.assertIsNone(dq_discovery.parse_name("SNOP_1_2_p.root"))
+        self.assertIsNone(dq_discovery.parse_name("SNOP_1_2.root.tmp"))
+        self.assertIsNone(dq_discovery.parse_name("rat.SNOP_1_2_p1.root"))
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+#
+# test_dq_prescan.py
+#
+# Run with: python -m unittest discover tests
+#
+###############################################################################
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+_dq_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for _path in [_dq_dir, os.path.join(_dq_dir, "utils")]:
+    if _path not in sys.path:
+        sys.path.append(_path)
+
+import dq_prescan
+
+def make_fz(record_lengths, order=">", physical_length=32):
+    """ Returns a synthetic ZEBRA FZ file holding a start-of-run logical
+    record then one data record (a type 2 logical record) of each of the
+    given lengths, in words, split into physical records of
+    physical_length words
+    """
+    records = [[1, 1, 0]]
+    for length in record_lengths:
+        records.append([length, dq_prescan.ZEBRA_LR_START]+[0x5a444142]*length)
+    starts = set()
+    stream = []
+    for record in records:
+        starts.add(len(stream))
+        stream += record
+    body = physical_length-dq_prescan.ZEBRA_STEERING_WORDS
+    words = []
+    for number, first in enumerate(range(0, len(stream), body)):
+        chunk = stream[first:first+body]
+        offset = 0 # no logical record starts in this physical record
+        for index in range(len(chunk)):
+            if (first+index) in starts:
+                offset = dq_prescan.ZEBRA_STEERING_WORDS+index
+                break
+        padding = body-len(chunk)
+        if (padding >= 2):
+            chunk += [padding-2, dq_prescan.ZEBRA_LR_PADDING[0]]
+            chunk += [0]*(padding-2)
+        else:
+            chunk += [0]*padding
+        words += [dq_prescan.ZEBRA_MAGIC, 0x80708070, 0x4321abcd, 0x80618061,
+                  physical_length, number, offset, 0]+chunk
+    return struct.pack(order+str(len(words))+"I", *words)
+
+class TestCountZdabEvents(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+    def count(self, data):
+        path = os.path.join(self._dir, "SNOP_0000100001_000.zdab")
+        with open(path, "wb") as zdab_file:
+            zdab_file.write(data)
+        return dq_prescan.count_zdab_events(path)
+    def test_small_records(self):
+        for order in [">", "<"]:
+            self.assertEqual(self.count(make_fz([3]*5, order)), 5)
+    def test_split_header(self):
+        """ The start-of-run record (3 words) and a 18-word record leave one
+        word of the first physical record for the next header
+        """
+        self.assertEqual(self.count(make_fz([18, 3, 3])), 3)
+    def test_continuation_record(self):
+        """ A record of 100 words fills physical records of 24 data words,
+        so that some have no logical record starting in them
+        """
+        for lengths in [[100], [3, 100, 3], [100, 100]]:
+            self.assertEqual(self.count(make_fz(lengths)), len(lengths))
+    def test_not_fz(self):
+        self.assertIsNone(self.count("not a zdab file"*10))
+        self.assertEqual(self.count(""), 0)
+
+if __name__=="__main__":
+    unittest.main()
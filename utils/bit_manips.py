@@ -7,27 +7,61 @@
 # Author A R Back - 27/02/2014 <ab571@sussex.ac.uk> : First revision
 #
 ###############################################################################
+import numpy
 
-def query_mask(bit, mask):
+def query_mask(bit, mask, applied=None):
     """ Queries a given bit in a bitmask, returns True if the bit is a one
     and returns False if the bit is a zero. Can also specify an applied mask,
-    then the function will check if the to make sure the
+    then the function only returns True if the bit is a one in both the mask
+    and applied mask.
     """
     query = 1<<bit # Shifts 1 to the position of bit = 1*(2**bit)
     result = False
     if (query&mask == query):
         result = True
+    if (applied is not None) and (query&applied != query):
+        result = False
     return result
-    
-def query_mask(bit, mask, applied):
-    """ Queries a given bit in a bitmask, returns true if the bit is a one
-    and returns false if the bit is a zero. Overloads the original version of
-    query mask so that here you can also specify an applied mask. Only returns
-    True if the bit is a one in both the mask and applied mask.
+
+def resolve_bits(bits, bit_index=None):
+    """ Converts a list of bits, given either as integer indices or as names,
+    to a list of integer indices. Names are looked up in the bit_index dict.
     """
-    query = 1<<bit # Shifts 1 to the position of bit = 1*(2**bit)
-    result = False
-    if (query&mask == query) and (query&applied == query):
-        result = True
-    return result
+    indices = []
+    for bit in bits:
+        if isinstance(bit, basestring):
+            try:
+                assert (bit_index is not None), ("bit_index must be supplied "
+                                                 "to query bits by name")
+                indices.append(bit_index[bit])
+            except (AssertionError, KeyError) as detail:
+                raise ValueError("bit_manips.resolve_bits: cannot resolve bit "
+                                 + repr(bit) + ", " + str(detail))
+        else:
+            indices.append(int(bit))
+    return indices
+
+def query_masks(masks, applied, bits, bit_index=None):
+    """ Vectorised query_mask. Given arrays of bitmasks and applied masks
+    (one 64-bit word per entry) and a list of bits (indices or names, see
+    resolve_bits), returns three boolean matrices of shape (entries, bits):
+    passed (bit set in both mask and applied), failed (applied but not set)
+    and not_applied.
+    """
+    masks = numpy.asarray(masks, dtype=numpy.uint64)
+    applied = numpy.asarray(applied, dtype=numpy.uint64)
+    indices = numpy.array(resolve_bits(bits, bit_index), dtype=numpy.uint64)
+    query = numpy.left_shift(numpy.uint64(1), indices)
+    is_set = (masks[:, numpy.newaxis] & query) != 0
+    is_applied = (applied[:, numpy.newaxis] & query) != 0
+    passed = is_set & is_applied
+    failed = is_applied & ~is_set
+    not_applied = ~is_applied
+    return passed, failed, not_applied
 
+def count_masks(masks, applied, bits, bit_index=None):
+    """ As query_masks, but returns the number of entries that passed,
+    failed and were not applied for each bit, as three integer arrays.
+    """
+    passed, failed, not_applied = query_masks(masks, applied, bits, bit_index)
+    return (passed.sum(axis=0), failed.sum(axis=0), not_applied.sum(axis=0))
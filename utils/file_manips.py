@@ -10,6 +10,7 @@
 import shutil
 import list_manips
 import os
+import errno
 
 def cut_path(path):
     """ When supplied a filepath, returns a substring that is the just the 
@@ -41,50 +42,168 @@ def split_ext(filename):
     ext=s[s.find("."):]
     return name, ext
 
-def copy_file(source, destination, passnum=1, version=2, overwrite=False):
-    """ A useful function to handle copying files to a different directory
+def _copy_to_temp(source, target):
+    """ Copies source to a temporary file alongside target, so that it can
+    then be renamed or linked into place. Returns the temporary path.
     """
-    def get_true_dest_from_message(detail):
-        message = str(detail).split()
-        if (message[2] == "'/home/ashley/Google"): # For Google Drive ONLY
-            true_dest = message[2]+" "+message[3] 
+    dir_, file_name = split_path(target)
+    temp = dir_+"."+file_name+".tmp."+str(os.getpid())
+    shutil.copy2(source, temp)
+    return temp
+
+def place_file(source, target, replace=False):
+    """ Atomically moves source to target, which is never seen partially
+    written. Unless replace is True, raises OSError with errno EEXIST if
+    target already exists, even if another process creates it concurrently.
+    Files on other file systems are copied next to target first.
+    """
+    if replace:
+        try:
+            os.rename(source, target)
+            return
+        except OSError as detail:
+            if (detail.errno != errno.EXDEV):
+                raise
+        temp = _copy_to_temp(source, target)
+        os.rename(temp, target)
+        os.remove(source)
+        return
+    try:
+        os.link(source, target) # fails if target exists
+        os.remove(source)
+        return
+    except OSError as detail:
+        if (detail.errno == errno.EEXIST):
+            raise
+    temp = _copy_to_temp(source, target)
+    try:
+        try:
+            os.link(temp, target)
+        except OSError as detail:
+            if (detail.errno == errno.EEXIST):
+                raise
+            # no hard links on this file system: claim the name with a
+            # marker beside it, so that target is never seen empty, then
+            # rename the copy into place
+            dir_, file_name = split_path(target)
+            claim = dir_+"."+file_name+".claim"
+            os.close(os.open(claim, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            try:
+                if os.path.lexists(target):
+                    raise OSError(errno.EEXIST, os.strerror(errno.EEXIST),
+                                  target)
+                os.rename(temp, target)
+            finally:
+                os.remove(claim)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+    os.remove(source)
+
+def _unversioned_names(file_name, passnum):
+    """ Returns the names copy_file tries for file_name before versioning
+    it (the name itself, then <name>_p<passnum><ext>), the stem to which
+    versions are added and the extension
+    """
+    name, ext = os.path.splitext(file_name)
+    pass_tag = "_p"+str(passnum)
+    pass_name = name if name.endswith(pass_tag) else name+pass_tag
+    names = [name+ext]
+    if (pass_name != name):
+        names.append(pass_name+ext)
+    return names, pass_name, ext
+
+def _first_free_version(is_taken, version):
+    """ Returns the lowest version, from version on, for which is_taken is
+    False, given that the versions taken are contiguous from version.
+    Versions version, version+1, version+3, version+7, ... are probed until
+    one is free and the last gap is then bisected, so only O(log n) of n
+    taken versions are probed.
+    """
+    if not is_taken(version):
+        return version
+    low, step = version, 1 # low is taken, low+step is probed next
+    while is_taken(low+step):
+        low += step
+        step *= 2
+    high = low+step # free
+    while (high-low > 1):
+        middle = (low+high)//2
+        if is_taken(middle):
+            low = middle
         else:
-            true_dest = message[2]
-        true_dest = true_dest[1:-1] # strip excess "'"
-        return true_dest
+            high = middle
+    return high
+
+def versioned_name(file_name, passnum=1, version=2, existing=()):
+    """ Returns the name copy_file would give file_name, with the "version"
+    policy, in a directory holding the names in existing. existing may also
+    be a function returning True if a name is taken.
+    """
+    if callable(existing):
+        is_taken = existing
+    else:
+        is_taken = lambda name: name in existing
+    names, pass_name, ext = _unversioned_names(file_name, passnum)
+    for candidate in names:
+        if not is_taken(candidate):
+            return candidate
+    version = _first_free_version(
+        lambda version: is_taken(pass_name+"_q"+str(version)+ext), version)
+    return pass_name+"_q"+str(version)+ext
+
+def copy_file(source, destination, passnum=1, version=2, overwrite=False,
+              policy="default"):
+    """ A useful function to handle moving files to a different directory.
+    If destination/<name><ext> is taken, the file is named <name>_p<passnum>
+    <ext> instead. What happens if that is also taken depends on policy:
 
-    is_copied = False
-    while not is_copied:
+      "version"   - use the next free <name>_p<passnum>_q<v><ext>, v >= version
+      "overwrite" - replace <name>_p<passnum><ext>
+      "skip"      - leave source where it is
+
+    The default policy is "overwrite" if overwrite is True, else "version".
+    Never prompts, and is safe to call from concurrent processes. Returns
+    the path the file was written to, or None if it was skipped.
+
+    The directory is never listed: candidate names are probed one at a
+    time (see versioned_name), so the cost does not grow with the number
+    of files already in it.
+    """
+    if (policy == "default"):
+        policy = "version"
+        if overwrite:
+            policy = "overwrite"
+    if policy not in ["version", "overwrite", "skip"]:
+        raise ValueError("file_manips.copy_file: unknown collision policy "
+                         +str(policy))
+    if os.path.isdir(destination):
+        dir_, file_name = destination, cut_path(source)
+    else:
+        dir_, file_name = split_path(destination)
+        dir_ = dir_ or "."
+    names = _unversioned_names(file_name, passnum)[0]
+    claimed = set() # names found taken when placing the file
+    def is_taken(name):
+        return (name in claimed) or os.path.lexists(os.path.join(dir_, name))
+    while True:
+        candidate = versioned_name(file_name, passnum, version, is_taken)
+        if (candidate not in names) and (policy != "version"):
+            break
+        target = os.path.join(dir_, candidate)
         try:
-            shutil.move(source, destination)
-            is_copied = True
-            print "writing to", destination
-        except shutil.Error as detail:
-            print "file_manips.copy_file: warning,", detail
-            true_dest = get_true_dest_from_message(detail)
-            path, file_name = split_path(true_dest)
-            name, ext = split_ext(file_name)
-            if (name.find("p") == -1):
-                new_source = name + "_p" + str(passnum) + ext
-                os.rename(source, new_source)
-                source = new_source
-                print "file_manips.copy_file: warning, renaming source file to:"
-                print source
-            if overwrite:
-                print "file_manips.copy_file: warning, file:"
-                print " -->", true_dest
-                print "will be overwritten, do you wish to continue y/[n]"
-                delete_file = raw_input()
-                if (delete_file == "y"):
-                    os.remove(true_dest)
-                else:
-                    print "moving", source, "to", true_dest, "aborted!"
-                    is_copied = True
-            else:
-                new_source = name[:name.find("_p" + str(passnum))+3] 
-                new_source += "_q" + str(version) + ext
-                os.rename(source, new_source)
-                source = new_source
-                print "file_manips.copy_file: warning, renaming source file to:"
-                print source
-                version += 1
+            place_file(source, target)
+            print "writing to", target
+            return target
+        except OSError as detail:
+            if (detail.errno != errno.EEXIST):
+                raise
+            claimed.add(candidate) # taken by a concurrent process
+    target = os.path.join(dir_, names[-1])
+    if (policy == "skip"):
+        print "file_manips.copy_file: warning, skipping", source,
+        print "as", target, "exists"
+        return None
+    print "file_manips.copy_file: warning, overwriting", target
+    place_file(source, target, replace=True)
+    return target